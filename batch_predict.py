@@ -0,0 +1,281 @@
+"""
+Offline batch prediction over large image directories with a model exported
+with `export_model`.
+
+Directories are walked lazily in sorted order and the images are processed
+in chunks of bounded size. While one chunk is predicted, the next is decoded,
+converted and transformed in the background, so memory use depends on the
+chunk size rather than the number of images. Results are appended to a CSV or
+JSON Lines file as each chunk completes, and a checkpoint is written next to
+the output so that an interrupted run can be resumed with `--resume`.
+Images which cannot be read are recorded with an error instead of a class.
+
+Usage:
+    python batch_predict.py path/to/export/export.json images/ -o out.csv
+    python batch_predict.py path/to/export/export.json images/ -o out.jsonl \\
+        --resume
+"""
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from modelling import decode_predictions, load_exported_model
+from pipeline.conversions import get_format
+from pipeline.dataset import image_to_data
+from pipeline.lib import process_map
+from pipeline.profiling import span
+from pipeline.transforms import apply_batch_transforms
+
+# Number of images processed and written at once
+CHUNK_SIZE = 1024
+
+# Output formats by file extension
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".json": "jsonl"}
+
+
+def iter_images(paths: Iterable[str]) -> Iterator[str]:
+    """
+    Lazily lists image files, walking directories recursively in sorted
+    order so that repeated runs see the images in the same order. Files are
+    treated as images if PIL recognises their extension.
+    :param paths: The image files and directories to list.
+    :return: An iterator over the image paths.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for e in entries:
+            if e.is_dir():
+                yield from iter_images([e.path])
+            elif get_format(e.name) is not None:
+                yield e.path
+
+
+def _load_raw(fp: str, conversions: List[str]) \
+        -> Tuple[Optional[np.ndarray], Optional[str]]:
+    """
+    Loads and converts an image, catching read errors.
+    :param fp: The image to load.
+    :param conversions: The list of conversions to apply.
+    :return: The converted image data and None, or None and the error.
+    """
+    try:
+        with Image.open(fp) as img:
+            return image_to_data(img, conversions, [], get_format(fp)), None
+    except (OSError, ValueError) as e:
+        return None, str(e) or type(e).__name__
+
+
+def _prepare(fps: List[str], process: Dict[str, Any]) \
+        -> Tuple[Optional[np.ndarray], List[Optional[str]]]:
+    """
+    Loads a chunk of images into model input data.
+    :param fps: The paths to the images.
+    :param process: The process the model was trained with.
+    :return: The data of the readable images, or None if there are none, and
+    the error of each image, None where it was read. Images converted to a
+    different shape than the first readable image of the chunk are recorded
+    as errors, as they cannot be stacked into one input.
+    """
+    loaded = process_map(_load_raw,
+                         [(fp, process["Conversions"]) for fp in fps],
+                         packed=True)
+    shape = next((a.shape for a, _ in loaded if a is not None), None)
+    errors = [e if a is None or a.shape == shape
+              else f"Image shape {a.shape} does not match {shape}"
+              for a, e in loaded]
+    arrs = [a for (a, _), e in zip(loaded, errors) if e is None]
+    if not arrs:
+        return None, errors
+    return apply_batch_transforms(np.array(arrs), process["Transforms"]), \
+        errors
+
+
+class ResultWriter:
+    """
+    Appends prediction results to a CSV or JSON Lines file, and records a
+    checkpoint of the work done after each chunk.
+
+    The checkpoint holds the number of images written, the last image path
+    and the size of the output at that point. On resume the output is
+    truncated to that size, dropping any rows written after the checkpoint.
+    """
+
+    def __init__(self, path: str, model: str, fmt: Optional[str] = None,
+                 resume: bool = False):
+        """
+        :param path: The output file.
+        :param model: The exported model, recorded in the checkpoint.
+        :param fmt: "csv" or "jsonl", defaulting to the format given by the
+        extension of the output file.
+        :param resume: Whether to continue from an existing checkpoint
+        instead of starting a new output.
+        """
+        self.path = path
+        self.checkpoint_path = f"{path}.checkpoint"
+        self.fmt = fmt or FORMATS.get(os.path.splitext(path)[1].lower(), "csv")
+        self.model = os.path.abspath(model)
+        self.processed = 0
+        self.last: Optional[str] = None
+        offset = 0
+        if resume and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, "r") as f:
+                checkpoint = json.load(f)
+            if checkpoint["Model"] != self.model:
+                raise ValueError(f"{path} was written with the model "
+                                 f"{checkpoint['Model']}")
+            self.processed = checkpoint["Processed"]
+            self.last = checkpoint["Last"]
+            offset = checkpoint["Offset"]
+        self._file = open(path, "r+b" if offset else "wb")
+        self._file.truncate(offset)
+        self._file.seek(offset)
+        if not offset and self.fmt == "csv":
+            self._write_rows([["Path", "Class", "Error"]])
+
+    def _write_rows(self, rows: List[List[str]]) -> None:
+        """
+        Writes CSV rows to the output.
+        :param rows: The rows to write.
+        :return: None.
+        """
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator="\n").writerows(rows)
+        self._file.write(buf.getvalue().encode())
+
+    def write(self, fps: List[str], labels: List[Optional[str]],
+              errors: List[Optional[str]]) -> None:
+        """
+        Appends the results of a chunk and checkpoints them.
+        :param fps: The image paths.
+        :param labels: The predicted class names, None for unreadable images.
+        :param errors: The read errors, None for readable images.
+        :return: None.
+        """
+        if self.fmt == "csv":
+            self._write_rows([[fp, label or "", error or ""] for fp, label,
+                              error in zip(fps, labels, errors)])
+        else:
+            self._file.write("".join(
+                json.dumps({"Path": fp, "Class": label, "Error": error}) + "\n"
+                for fp, label, error in zip(fps, labels, errors)).encode())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.processed += len(fps)
+        self.last = fps[-1]
+        tmp = f"{self.checkpoint_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"Model": self.model, "Processed": self.processed,
+                       "Last": self.last, "Offset": self._file.tell()}, f)
+        os.replace(tmp, self.checkpoint_path)
+
+    def close(self) -> None:
+        """
+        Closes the output.
+        :return: None.
+        """
+        self._file.close()
+
+
+def _skip_done(fps: Iterator[str], last: Optional[str]) -> Iterator[str]:
+    """
+    Skips the images written before a checkpoint.
+    :param fps: The image paths, in the order of the original run.
+    :param last: The last image written, or None to skip nothing.
+    :return: The remaining image paths.
+    """
+    if last is None:
+        return fps
+    for fp in fps:
+        if fp == last:
+            return fps
+    raise ValueError(f"Checkpointed image {last} was not found in the inputs")
+
+
+def batch_predict(exported_model: str, paths: List[str], output: str,
+                  chunk_size: int = CHUNK_SIZE, fmt: Optional[str] = None,
+                  resume: bool = False, verbose: bool = True) -> int:
+    """
+    Predicts the class of every image under the given paths, writing the
+    results incrementally. Loading and transforming the next chunk overlaps
+    with predicting the current one.
+    :param exported_model: A model exported with `export_model`, as accepted
+    by `load_exported_model`.
+    :param paths: Image files and directories of images.
+    :param output: The CSV or JSON Lines file to write results to.
+    :param chunk_size: The number of images processed at once.
+    :param fmt: "csv" or "jsonl", defaulting to the extension of the output.
+    :param resume: Whether to continue an interrupted run from its checkpoint.
+    :param verbose: Whether to report progress on stderr.
+    :return: The total number of images written, including earlier runs.
+    """
+    process, classifier = load_exported_model(exported_model)
+    writer = ResultWriter(output, exported_model, fmt, resume)
+    fps = _skip_done(iter_images(paths), writer.last)
+    chunks = iter(lambda: list(itertools.islice(fps, chunk_size)), [])
+    start, done = time.perf_counter(), 0
+    try:
+        with ThreadPoolExecutor(1) as executor:
+            chunk = next(chunks, None)
+            pending: Optional[Future] = \
+                executor.submit(_prepare, chunk, process) if chunk else None
+            while pending is not None:
+                data, errors = pending.result()
+                current = chunk
+                chunk = next(chunks, None)
+                pending = executor.submit(_prepare, chunk, process) \
+                    if chunk else None
+                labels: List[Optional[str]] = [None] * len(current)
+                if data is not None:
+                    with span("predict"):
+                        pred = iter(decode_predictions(
+                            process, classifier.predict(data)))
+                    labels = [None if e else next(pred) for e in errors]
+                writer.write(current, labels, errors)
+                done += len(current)
+                if verbose:
+                    rate = done / (time.perf_counter() - start)
+                    print(f"{writer.processed} images, {rate:.1f}/s",
+                          file=sys.stderr)
+    finally:
+        writer.close()
+    return writer.processed
+
+
+def main() -> None:
+    """
+    Runs batch prediction from the command line.
+    :return: None.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("model", help="A model exported with export_model.")
+    parser.add_argument("paths", nargs="+",
+                        help="Image files and directories of images.")
+    parser.add_argument("-o", "--output", required=True,
+                        help="The .csv or .jsonl file to write results to.")
+    parser.add_argument("--format", choices=["csv", "jsonl"])
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from its "
+                             "checkpoint.")
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args()
+    batch_predict(args.model, args.paths, args.output, args.chunk_size,
+                  args.format, args.resume, not args.quiet)
+
+
+if __name__ == "__main__":
+    main()
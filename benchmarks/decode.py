@@ -0,0 +1,89 @@
+"""
+Benchmarks reduced-resolution decoding for the "Size Scaled" conversion
+against a full resolution decode, on synthetic photo-sized images.
+
+Usage:
+    python benchmarks/decode.py [--images 20] [--size 4000x3000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Qualities compared, where 0 is a full resolution decode
+QUALITIES = [0, 4, 2, 1]
+
+
+def _make_photo(fp: str, width: int, height: int, seed: int) -> None:
+    """
+    Writes a smooth synthetic photo-like image with some noise.
+    :param fp: The path to write to, with the extension giving the format.
+    :param width: The width of the image.
+    :param height: The height of the image.
+    :param seed: The random seed.
+    :return: None.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype("float32")
+    channels = [
+        127 + 100 * np.sin(x / rng.uniform(50, 400) + rng.uniform(0, 6))
+        * np.cos(y / rng.uniform(50, 400))
+        for _ in range(3)
+    ]
+    arr = np.stack(channels, axis=-1) + rng.normal(0, 8, (height, width, 3))
+    Image.fromarray(np.clip(arr, 0, 255).astype("uint8")).save(fp)
+
+
+def main() -> None:
+    """
+    Runs the benchmark and prints a table of results.
+    :return: None.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--size", default="4000x3000")
+    parser.add_argument("--format", default="jpg", choices=["jpg", "png"])
+    args = parser.parse_args()
+    width, height = (int(v) for v in args.size.split("x"))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        from pipeline import conversions
+
+        sources = [f"{tmp}/photo-{i}.{args.format}"
+                   for i in range(args.images)]
+        for i, fp in enumerate(sources):
+            _make_photo(fp, width, height, i)
+
+        steps = ["Grayscale", "Size Scaled"]
+        results = {}
+        for quality in QUALITIES:
+            conversions.DRAFT_QUALITY = quality
+            start = time.perf_counter()
+            outputs = [conversions.convert_chain(
+                fp, steps, f"{tmp}/out-{quality}-{i}.png")
+                for i, fp in enumerate(sources)]
+            elapsed = time.perf_counter() - start
+            results[quality] = (elapsed, [np.array(Image.open(o), "float32")
+                                          for o in outputs])
+
+        base_time, base = results[0]
+        print(f"{args.images} {width}x{height} {args.format} images, "
+              f"scaled to {conversions.WIDTH}x{conversions.HEIGHT}")
+        print(f"{'quality':>8} {'seconds':>9} {'img/s':>8} {'speedup':>8} "
+              f"{'mean abs diff':>14}")
+        for quality, (elapsed, arrs) in results.items():
+            diff = np.mean([np.abs(a - b).mean() for a, b in zip(arrs, base)])
+            print(f"{quality or 'full':>8} {elapsed:9.3f} "
+                  f"{args.images / elapsed:8.1f} {base_time / elapsed:7.2f}x "
+                  f"{diff:14.3f}")
+
+
+if __name__ == "__main__":
+    main()
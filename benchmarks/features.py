@@ -0,0 +1,79 @@
+"""
+Benchmarks the feature-extraction transforms against the raw-pixel baseline
+on synthetic chart images, recording the feature size, transform time, fit
+and predict time and accuracy of a classifier trained on each feature set.
+
+Usage:
+    python benchmarks/features.py [--images 600] [--classifier svc]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import make_images  # noqa: E402
+
+# Conversions applied to every image before the transforms
+CONVERSIONS = ["Grayscale", "Size Scaled"]
+
+# Feature sets compared, the first being the baseline
+FEATURES: Dict[str, List[str]] = {
+    "raw pixels": ["Scale Pixels", "Flatten"],
+    "downsample": ["Downsample", "Scale Pixels", "Flatten"],
+    "gradient histogram": ["Gradient Histogram"],
+    "intensity histogram": ["Intensity Histogram"],
+    "random projection": ["Scale Pixels", "Random Projection"],
+    "downsample + projection": ["Downsample", "Scale Pixels",
+                                "Random Projection"]
+}
+
+
+def main() -> None:
+    """
+    Runs the benchmark and prints a table of results.
+    :return: None.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--images", type=int, default=600)
+    parser.add_argument("--classifier", choices=["sgd", "svc"], default="svc")
+    args = parser.parse_args()
+
+    from sklearn.model_selection import train_test_split
+    from pipeline.dataset import load_images
+    from pipeline.transforms import apply_batch_transforms
+    from run import _make_classifier
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths, labels = make_images(tmp, args.images)
+        images = load_images(paths, CONVERSIONS, [])
+    labels = np.array(labels)
+    train, test = train_test_split(np.arange(len(labels)), test_size=0.25,
+                                   random_state=0, stratify=labels)
+
+    print(f"{args.images} images, {args.classifier}")
+    print(f"{'features':<26} {'size':>7} {'transform s':>12} {'fit s':>8} "
+          f"{'predict s':>10} {'accuracy':>9}")
+    for name, transforms in FEATURES.items():
+        start = time.perf_counter()
+        x = apply_batch_transforms(images, transforms)
+        transform_time = time.perf_counter() - start
+        classifier = _make_classifier(args.classifier)
+        start = time.perf_counter()
+        classifier.fit(x[train], labels[train])
+        fit_time = time.perf_counter() - start
+        start = time.perf_counter()
+        pred = classifier.predict(x[test])
+        predict_time = time.perf_counter() - start
+        accuracy = float(np.mean(pred == labels[test]))
+        print(f"{name:<26} {x.shape[1]:>7} {transform_time:12.3f} "
+              f"{fit_time:8.3f} {predict_time:10.3f} {accuracy:9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Checks the cold import cost of the inference path, for use as a regression
+check. Each module is imported in a fresh interpreter in an empty temporary
+directory, failing if it imports a heavy dependency that should be deferred,
+touches the filesystem, or takes longer than the time budget.
+
+Usage:
+    python benchmarks/imports.py [--budget 1.5] [--repeat 5]
+
+The exit status is 1 if any check fails.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Default maximum import time of each module in seconds
+BUDGET = 1.5
+
+# Modules on the inference path, with the dependencies they must not import
+# until used
+CHECKS: Dict[str, List[str]] = {
+    "pipeline": ["numpy", "PIL", "pandas", "sklearn", "requests"],
+    "modelling": ["pandas", "sklearn", "requests"],
+    "server": ["pandas", "sklearn", "requests"]
+}
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure(module: str) -> Dict[str, Any]:
+    """
+    Imports a module in a fresh interpreter in an empty directory.
+    :param module: The module to import.
+    :return: The import time in seconds, the modules loaded and the files
+    created in the working directory.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.pathsep.join(filter(None, [ROOT,
+                                             os.environ.get("PYTHONPATH")]))
+        env = dict(os.environ, PYTHONPATH=path, PYTHONDONTWRITEBYTECODE="1")
+        output = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module)], cwd=tmp,
+            env=env, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output)
+        result["created"] = sorted(os.listdir(tmp))
+    return result
+
+
+def check(module: str, forbidden: List[str], budget: float,
+          repeat: int) -> List[str]:
+    """
+    Checks the cold import of a module.
+    :param module: The module to import.
+    :param forbidden: The top-level packages it must not import.
+    :param budget: The maximum import time in seconds.
+    :param repeat: The number of imports to take the fastest of.
+    :return: A description of each failure.
+    """
+    results = [measure(module) for _ in range(repeat)]
+    seconds = min(r["seconds"] for r in results)
+    loaded = {m.split(".")[0] for m in results[0]["modules"]}
+    print(f"{module:<12} {seconds * 1000:9.1f} ms "
+          f"{len(results[0]['modules']):6} modules", file=sys.stderr)
+    failures = [f"{module} imports {m}" for m in forbidden if m in loaded]
+    if results[0]["created"]:
+        failures.append(f"{module} creates {', '.join(results[0]['created'])}"
+                        f" on import")
+    if seconds > budget:
+        failures.append(f"{module} takes {seconds:.3f}s to import, over the "
+                        f"budget of {budget:.3f}s")
+    return failures
+
+
+def main() -> None:
+    """
+    Runs the checks from the command line.
+    :return: None.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--budget", type=float, default=BUDGET,
+                        help="Maximum import time of each module in seconds.")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    failures = []
+    for module, forbidden in CHECKS.items():
+        failures += check(module, forbidden, args.budget, args.repeat)
+    for f in failures:
+        print(f"FAIL {f}", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
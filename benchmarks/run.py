@@ -0,0 +1,258 @@
+"""
+Benchmarks the pipeline end to end on synthetic chart images at several
+dataset sizes, recording the wall time, throughput and peak memory of each
+stage. Each size runs in a fresh data store in a temporary directory.
+
+Usage:
+    python benchmarks/run.py --sizes 50 200 1000 --output results.json
+    python benchmarks/run.py --baseline results.json --threshold 0.2
+    python benchmarks/run.py --sizes 200 --trace trace.json
+
+With `--baseline`, stages slower than the baseline by more than the threshold
+are reported as regressions and the exit status is 1. With `--trace`, the
+pipeline is instrumented with `pipeline.profiling`, a per-stage summary is
+printed and a Chrome trace is written to the given file.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import make_images  # noqa: E402
+
+# Interval in seconds between memory samples
+SAMPLE_INTERVAL = 0.01
+
+# Number of images classified by the prediction stages
+PREDICT_IMAGES = 50
+
+
+def _rss() -> int:
+    """
+    Reads the resident set size of this process.
+    :return: The resident set size in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class _PeakMemory:
+    """
+    Samples the resident set size in a background thread, recording the peak.
+    Memory used by worker processes is not included.
+    """
+
+    def __enter__(self):
+        """
+        Starts sampling.
+        :return: The sampler, whose `peak` attribute holds the peak in bytes.
+        """
+        self.peak = _rss()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self) -> None:
+        """
+        Samples until the block is exited.
+        :return: None.
+        """
+        while not self._done.wait(SAMPLE_INTERVAL):
+            self.peak = max(self.peak, _rss())
+
+    def __exit__(self, *args):
+        """
+        Stops sampling.
+        :return: None.
+        """
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+
+
+def _measure(stage: str, size: int, images: int, f: Callable[[], Any],
+             results: List[Dict[str, Any]]) -> Any:
+    """
+    Runs and measures a stage, discarding its printed output.
+    :param stage: The name of the stage.
+    :param size: The dataset size being benchmarked.
+    :param images: The number of images processed by the stage.
+    :param f: The stage to run.
+    :param results: The list to append the measurement to.
+    :return: The result of the stage.
+    """
+    with _PeakMemory() as memory, \
+            contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = f()
+        elapsed = time.perf_counter() - start
+    results.append({
+        "size": size,
+        "stage": stage,
+        "seconds": elapsed,
+        "images_per_second": images / elapsed if elapsed else 0.0,
+        "peak_rss_mb": memory.peak / 1024 ** 2
+    })
+    print(f"{size:>7} {stage:<24} {elapsed:9.3f}s "
+          f"{results[-1]['images_per_second']:9.1f} img/s "
+          f"{results[-1]['peak_rss_mb']:9.1f} MB", file=sys.stderr)
+    return result
+
+
+def _make_classifier(name: str):
+    """
+    Creates the classifier to benchmark training with.
+    :param name: The name of the classifier.
+    :return: The classifier.
+    """
+    if name == "svc":
+        from sklearn.svm import SVC
+        return SVC()
+    from sklearn.linear_model import SGDClassifier
+    return SGDClassifier()
+
+
+def run_size(size: int, classifier: str,
+             directory: str) -> List[Dict[str, Any]]:
+    """
+    Benchmarks every stage for one dataset size.
+    :param size: The number of images.
+    :param classifier: The name of the classifier to train.
+    :param directory: An empty directory to hold the source images, data
+    store and export.
+    :return: The measurements of each stage.
+    """
+    from modelling import end_to_end_prediction, export_model, train_and_save
+    from pipeline.context import DataStore
+    from pipeline.conversions import CONVERSIONS
+    from pipeline.dataset import make_data, new_dataset
+    from pipeline.store import convert_images, import_images, \
+        init_data_store, read_store
+
+    results: List[Dict[str, Any]] = []
+    conversions, transforms = list(CONVERSIONS), ["Scale Pixels", "Flatten"]
+    paths, labels = make_images(os.path.join(directory, "source"), size,
+                                seed=size)
+    store = DataStore(os.path.join(directory, "data"))
+    init_data_store(store)
+
+    _measure("import_images", size, size,
+             lambda: import_images(paths, labels, store=store), results)
+    files = list(read_store(store)["File"])
+    _measure("convert_images", size, size,
+             lambda: convert_images(files, conversions, store), results)
+    files = list(read_store(store)["File"])
+    dataset = _measure("new_dataset", size, size,
+                       lambda: new_dataset(files, conversions, store=store),
+                       results)
+    _measure("make_data", size, size,
+             lambda: make_data(dataset, transforms, False, store=store),
+             results)
+    _measure("train_and_save", size, size,
+             lambda: train_and_save(_make_classifier(classifier), dataset,
+                                    transforms, False, store=store), results)
+    exported = export_model(dataset, os.path.join(directory, "export"))
+    sample = paths[:PREDICT_IMAGES]
+    _measure("end_to_end_prediction", size, len(sample),
+             lambda: end_to_end_prediction(exported, sample, store=store),
+             results)
+    _measure("end_to_end_in_memory", size, len(sample),
+             lambda: end_to_end_prediction(exported, sample, in_memory=True,
+                                           store=store), results)
+    return results
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]],
+            threshold: float) -> List[str]:
+    """
+    Compares measurements against a baseline.
+    :param results: The current measurements.
+    :param baseline: The baseline measurements.
+    :param threshold: The tolerated relative slowdown.
+    :return: A description of each regression.
+    """
+    base = {(r["size"], r["stage"]): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get((r["size"], r["stage"]))
+        if b is None or not b["seconds"]:
+            continue
+        ratio = r["seconds"] / b["seconds"]
+        if ratio > 1 + threshold:
+            regressions.append(f"{r['stage']} at size {r['size']}: "
+                               f"{b['seconds']:.3f}s -> {r['seconds']:.3f}s "
+                               f"({ratio:.2f}x)")
+    return regressions
+
+
+def main() -> None:
+    """
+    Runs the benchmarks from the command line.
+    :return: None.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[50, 200, 1000])
+    parser.add_argument("--classifier", choices=["sgd", "svc"], default="sgd")
+    parser.add_argument("--output", help="Write results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare against this JSON file.")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--trace", help="Write a Chrome trace to this file.")
+    args = parser.parse_args()
+
+    from pipeline import profiling
+    if args.trace:
+        profiling.enable()
+
+    results = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            results += run_size(size, args.classifier, tmp)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cores": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "classifier": args.classifier
+        },
+        "results": results
+    }
+    if args.trace:
+        profiling.dump_trace(args.trace)
+        with contextlib.redirect_stdout(sys.stderr):
+            profiling.print_summary()
+    if args.output:
+        with open(args.output, "w+") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Generates synthetic chart-like images for benchmarking, so that benchmarks do
+not depend on an external corpus.
+"""
+import os
+import random
+from typing import Callable, Dict, List, Tuple
+
+from PIL import Image, ImageDraw
+
+# Canvas size of generated images, larger than the pipeline scaling size so
+# that scaling does real work
+SIZE = (800, 600)
+
+
+def _axes(draw: ImageDraw.ImageDraw) -> Tuple[int, int, int, int]:
+    """
+    Draws a pair of axes.
+    :param draw: The drawing context.
+    :return: The left, top, right and bottom of the plot area.
+    """
+    left, top, right, bottom = 80, 40, SIZE[0] - 40, SIZE[1] - 60
+    draw.line([(left, top), (left, bottom), (right, bottom)], fill="black",
+              width=3)
+    return left, top, right, bottom
+
+
+def _bar_graph(draw: ImageDraw.ImageDraw, rng: random.Random) -> None:
+    """
+    Draws a bar graph.
+    :param draw: The drawing context.
+    :param rng: The random number generator.
+    :return: None.
+    """
+    left, top, right, bottom = _axes(draw)
+    n = rng.randint(3, 12)
+    width = (right - left) / n
+    for i in range(n):
+        height = rng.uniform(0.1, 1) * (bottom - top)
+        draw.rectangle([left + i * width + 5, bottom - height,
+                        left + (i + 1) * width - 5, bottom],
+                       fill=tuple(rng.randint(0, 200) for _ in range(3)))
+
+
+def _line_graph(draw: ImageDraw.ImageDraw, rng: random.Random) -> None:
+    """
+    Draws a line graph.
+    :param draw: The drawing context.
+    :param rng: The random number generator.
+    :return: None.
+    """
+    left, top, right, bottom = _axes(draw)
+    for _ in range(rng.randint(1, 4)):
+        n = rng.randint(5, 30)
+        points = [(left + i * (right - left) / (n - 1),
+                   rng.uniform(top, bottom)) for i in range(n)]
+        draw.line(points, fill=tuple(rng.randint(0, 200) for _ in range(3)),
+                  width=3)
+
+
+def _scatter_graph(draw: ImageDraw.ImageDraw, rng: random.Random) -> None:
+    """
+    Draws a scatter graph.
+    :param draw: The drawing context.
+    :param rng: The random number generator.
+    :return: None.
+    """
+    left, top, right, bottom = _axes(draw)
+    for _ in range(rng.randint(20, 200)):
+        x, y = rng.uniform(left, right), rng.uniform(top, bottom)
+        draw.ellipse([x - 4, y - 4, x + 4, y + 4], fill="blue")
+
+
+def _pie_chart(draw: ImageDraw.ImageDraw, rng: random.Random) -> None:
+    """
+    Draws a pie chart.
+    :param draw: The drawing context.
+    :param rng: The random number generator.
+    :return: None.
+    """
+    weights = [rng.random() for _ in range(rng.randint(2, 8))]
+    angle = 0.0
+    box = [200, 100, 600, 500]
+    for w in weights:
+        extent = 360 * w / sum(weights)
+        draw.pieslice(box, angle, angle + extent,
+                      fill=tuple(rng.randint(0, 255) for _ in range(3)),
+                      outline="white")
+        angle += extent
+
+
+def _table(draw: ImageDraw.ImageDraw, rng: random.Random) -> None:
+    """
+    Draws a table of numbers.
+    :param draw: The drawing context.
+    :param rng: The random number generator.
+    :return: None.
+    """
+    rows, cols = rng.randint(3, 15), rng.randint(2, 6)
+    for r in range(rows + 1):
+        y = 40 + r * (SIZE[1] - 80) / rows
+        draw.line([(40, y), (SIZE[0] - 40, y)], fill="black", width=2)
+    for c in range(cols + 1):
+        x = 40 + c * (SIZE[0] - 80) / cols
+        draw.line([(x, 40), (x, SIZE[1] - 40)], fill="black", width=2)
+    for r in range(rows):
+        for c in range(cols):
+            draw.text((50 + c * (SIZE[0] - 80) / cols,
+                       45 + r * (SIZE[1] - 80) / rows),
+                      str(rng.randint(0, 9999)), fill="black")
+
+
+def _not_graph(draw: ImageDraw.ImageDraw, rng: random.Random) -> None:
+    """
+    Draws overlapping circles, as a non-chart image.
+    :param draw: The drawing context.
+    :param rng: The random number generator.
+    :return: None.
+    """
+    for _ in range(rng.randint(10, 60)):
+        x, y = rng.uniform(0, SIZE[0]), rng.uniform(0, SIZE[1])
+        r = rng.uniform(10, 150)
+        draw.ellipse([x - r, y - r, x + r, y + r],
+                     fill=tuple(rng.randint(0, 255) for _ in range(3)))
+
+
+# Generators of each class, keyed by class name from CLASSES
+GENERATORS: Dict[str, Callable[[ImageDraw.ImageDraw, random.Random], None]] = {
+    "BarGraph": _bar_graph,
+    "LineGraph": _line_graph,
+    "ScatterGraph": _scatter_graph,
+    "PieChart": _pie_chart,
+    "Table": _table,
+    "NotGraph": _not_graph
+}
+
+
+def make_images(directory: str, n: int, seed: int = 0,
+                extension: str = "png") -> Tuple[List[str], List[str]]:
+    """
+    Generates synthetic images, cycling through the classes of GENERATORS.
+    :param directory: The directory to write the images to.
+    :param n: The number of images to generate.
+    :param seed: The random seed.
+    :param extension: The image format to write.
+    :return: The paths to the images and their class labels.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    classes = list(GENERATORS)
+    paths, labels = [], []
+    for i in range(n):
+        label = classes[i % len(classes)]
+        img = Image.new("RGB", SIZE, "white")
+        GENERATORS[label](ImageDraw.Draw(img), rng)
+        path = f"{directory}/{seed}-{i}.{extension}"
+        img.save(path)
+        paths.append(path)
+        labels.append(label)
+    return paths, labels
@@ -1,20 +1,160 @@
+import hashlib
+import json
 import os
-from typing import List
+import time
+import uuid
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
 import joblib
 import numpy as np
-import pandas as pd
-from sklearn.base import ClassifierMixin
-from sklearn.metrics import classification_report, confusion_matrix
-from sklearn.model_selection import train_test_split
 
-from pipeline.dataset import get_process, make_data, new_dataset, delete_dataset
-from pipeline.store import CLASSES
+from pipeline import lib
+from pipeline.context import DataStore
+from pipeline.dataset import get_process, make_data, new_dataset, \
+    delete_dataset, iter_batches, load_data, load_images
+from pipeline.profiling import span
+from pipeline.store import decode_labels
 
+if TYPE_CHECKING:
+    from sklearn.base import ClassifierMixin
 
-def train_and_save(classifier: ClassifierMixin, dataset: str,
+# Number of samples passed to each predict call by `batched_predict`
+PREDICT_BATCH_SIZE = 1024
+
+# Number of samples passed to each partial_fit call by `train_incremental`
+TRAIN_BATCH_SIZE = 256
+
+# Number of cross-validation folds used by `model_search`
+SEARCH_FOLDS = 5
+
+# Version of the export format written by `export_model`
+EXPORT_VERSION = 2
+
+# Read size when copying and checksumming exported models
+EXPORT_CHUNK_SIZE = 1024 * 1024
+
+
+def split_indices(n: int, test_proportion: float = 0.1) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Randomly splits the indices of a dataset into train and test indices,
+    without copying the data itself.
+    :param n: The number of samples in the dataset.
+    :param test_proportion: What percentage of the dataset to use for testing.
+    :return: The sorted train and test indices.
+    """
+    from sklearn.model_selection import train_test_split
+
+    train, test = train_test_split(np.arange(n), test_size=test_proportion)
+    return np.sort(train), np.sort(test)
+
+
+def batched_predict(classifier: "ClassifierMixin", images: np.ndarray,
+                    indices: Optional[np.ndarray] = None,
+                    batch_size: int = PREDICT_BATCH_SIZE) -> np.ndarray:
+    """
+    Predicts over a possibly memory-mapped array in batches, so that at most
+    `batch_size` samples are read into memory at once.
+    :param classifier: The classifier to predict with.
+    :param images: The image data.
+    :param indices: The indices of the samples to predict, or all samples.
+    :param batch_size: The number of samples to predict at once.
+    :return: The predictions.
+    """
+    n = len(images) if indices is None else len(indices)
+    if n == 0:
+        return np.array([])
+    pred = []
+    for start in range(0, n, batch_size):
+        if indices is None:
+            batch = images[start:start + batch_size]
+        else:
+            batch = images[indices[start:start + batch_size]]
+        with span("predict"):
+            pred.append(classifier.predict(batch))
+    return np.concatenate(pred)
+
+
+def print_report(labels: np.ndarray, pred: np.ndarray) -> None:
+    """
+    Prints the classification report and confusion matrix of predictions.
+    :param labels: The true labels.
+    :param pred: The predicted labels.
+    :return: None.
+    """
+    import pandas as pd
+    from sklearn.metrics import classification_report, confusion_matrix
+
+    print(classification_report(labels, pred))
+    print(pd.DataFrame(confusion_matrix(labels, pred)))
+
+
+def train_incremental(classifier: "ClassifierMixin", dataset: str,
+                      transforms: List[str], bundled: bool,
+                      test_proportion: float = 0.1,
+                      batch_size: int = TRAIN_BATCH_SIZE, epochs: int = 1,
+                      from_images: bool = False, seed: Optional[int] = None,
+                      store: Optional[DataStore] = None) -> None:
+    """
+    Trains on the given dataset out of core and saves the model. The
+    classifier is fed shuffled mini-batches with `partial_fit`, and evaluated
+    on the held-out samples in batches, so that at most one batch of samples
+    is in memory at once.
+    :param classifier: The classifier to train, which must support
+    `partial_fit`.
+    :param dataset: The dataset to train on.
+    :param transforms: The transforms to apply to the data.
+    :param bundled: Whether to bundle chart classes together.
+    :param test_proportion: What percentage of the dataset to use for testing.
+    :param batch_size: The number of samples per mini-batch.
+    :param epochs: The number of passes over the training samples.
+    :param from_images: Whether to decode and transform the dataset images as
+    each batch is read instead of materialising X.npy.
+    :param seed: The seed of the shuffling, for reproducible training.
+    :param store: The data store holding the transform cache, or the default
+    store.
+    :return: None.
+    """
+    if not hasattr(classifier, "partial_fit"):
+        raise ValueError(f"{type(classifier).__name__} does not support "
+                         f"partial_fit")
+    if not make_data(dataset, transforms, bundled, store=store,
+                     images=not from_images):
+        raise FileNotFoundError
+    labels = np.load(f"{dataset}/Y.npy")
+    train, test = split_indices(len(labels), test_proportion)
+    classes = np.unique(labels)
+    source = transforms if from_images else None
+    rng = np.random.default_rng(seed)
+    for epoch in range(epochs):
+        # Shuffle across the whole training set, then sort within each batch
+        # so that samples are read in file order
+        order = rng.permutation(train)
+        order = np.concatenate([np.sort(order[i:i + batch_size])
+                                for i in range(0, len(order), batch_size)]) \
+            if len(order) else order
+        for start, batch in zip(range(0, len(order), batch_size),
+                                iter_batches(dataset, order, batch_size,
+                                             source)):
+            with span("partial_fit"):
+                classifier.partial_fit(batch,
+                                       labels[order[start:start + batch_size]],
+                                       classes=classes)
+        print(f"Epoch {epoch + 1}/{epochs}")
+    pred = []
+    for batch in iter_batches(dataset, test, PREDICT_BATCH_SIZE, source):
+        with span("predict"):
+            pred.append(classifier.predict(batch))
+    if pred:
+        print_report(labels[test], np.concatenate(pred))
+    joblib.dump(classifier, f"{dataset}/model.joblib")
+
+
+def train_and_save(classifier: "ClassifierMixin", dataset: str,
                    transforms: List[str], bundled: bool,
-                   test_proportion: int = 0.1) -> None:
+                   test_proportion: int = 0.1, mmap: bool = True,
+                   store: Optional[DataStore] = None,
+                   incremental: bool = False, **kwargs) -> None:
     """
     Trains on the given dataset and saves model.
     :param classifier: The classifier to train.
@@ -22,21 +162,150 @@ def train_and_save(classifier: ClassifierMixin, dataset: str,
     :param transforms: The transforms to apply to the data.
     :param bundled: Whether to bundle chart classes together.
     :param test_proportion: What percentage of the dataset to use for testing.
+    :param mmap: Whether to memory-map the dataset, reading only the training
+    samples into memory and predicting the test samples in batches.
+    :param store: The data store holding the transform cache, or the default
+    store.
+    :param incremental: Whether to train out of core with `partial_fit`, for
+    datasets larger than memory. See `train_incremental`, to which further
+    keyword arguments are passed.
     :return: None.
     """
-    if not make_data(dataset, transforms, bundled):
+    if incremental:
+        return train_incremental(classifier, dataset, transforms, bundled,
+                                 test_proportion, store=store, **kwargs)
+    if not make_data(dataset, transforms, bundled, store=store):
         raise FileNotFoundError
-    images, labels = np.load(f"{dataset}/X.npy"), np.load(f"{dataset}/Y.npy")
-    X_train, X_test, Y_train, Y_test = \
-        train_test_split(images, labels, test_size=test_proportion)
-    classifier.fit(X_train, Y_train)
-    pred = classifier.predict(X_test)
-    print(classification_report(Y_test, pred))
-    print(pd.DataFrame(confusion_matrix(Y_test, pred)))
+    images, labels = load_data(dataset, mmap)
+    train, test = split_indices(len(labels), test_proportion)
+    with span("fit"):
+        classifier.fit(images[train], labels[train])
+    pred = batched_predict(classifier, images, test)
+    print_report(labels[test], pred)
     joblib.dump(classifier, f"{dataset}/model.joblib")
 
 
-def load_and_predict(model_dataset: str, test_dataset: str) -> None:
+def _evaluate_candidate(classifier: "ClassifierMixin", params: Dict[str, Any],
+                        images: np.ndarray, labels: np.ndarray,
+                        train: np.ndarray, test: np.ndarray) \
+        -> Tuple[float, float, float]:
+    """
+    Fits and scores one candidate on one cross-validation fold.
+    :param classifier: The classifier, which is cloned before fitting.
+    :param params: The hyperparameters to set on the classifier.
+    :param images: The image data, memory-mapped and shared with the other
+    workers.
+    :param labels: The labels.
+    :param train: The indices of the training samples of the fold.
+    :param test: The indices of the test samples of the fold.
+    :return: The accuracy on the test samples, and the fit and predict times
+    in seconds.
+    """
+    from sklearn.base import clone
+
+    candidate = clone(classifier).set_params(**params)
+    start = time.perf_counter()
+    candidate.fit(images[train], labels[train])
+    fit_time = time.perf_counter() - start
+    start = time.perf_counter()
+    pred = batched_predict(candidate, images, test)
+    predict_time = time.perf_counter() - start
+    return float(np.mean(pred == labels[test])), fit_time, predict_time
+
+
+def _jsonable(value: Any) -> Any:
+    """
+    Makes a hyperparameter value JSON serialisable.
+    :param value: The value.
+    :return: The value, or its representation if it is not a JSON scalar.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+
+def model_search(candidates: List[Tuple["ClassifierMixin",
+                                        Dict[str, List[Any]]]],
+                 dataset: str, transforms: List[str], bundled: bool,
+                 folds: int = SEARCH_FOLDS, n_jobs: Optional[int] = None,
+                 seed: Optional[int] = None,
+                 store: Optional[DataStore] = None) -> List[Dict[str, Any]]:
+    """
+    Selects a model for the given dataset by k-fold cross-validation over a
+    grid of classifiers and hyperparameters, and saves the best one as
+    `train_and_save` would. The training data is made once and memory-mapped,
+    so parallel workers share it instead of receiving copies.
+    :param candidates: Each classifier with a grid of hyperparameters to try,
+    mapping parameter names to lists of values as in scikit-learn's
+    `ParameterGrid`. An empty grid tries the classifier as given.
+    :param dataset: The dataset to train on.
+    :param transforms: The transforms to apply to the data.
+    :param bundled: Whether to bundle chart classes together.
+    :param folds: The number of cross-validation folds.
+    :param n_jobs: The number of parallel workers, defaulting to POOL_SIZE.
+    :param seed: The seed of the fold assignment.
+    :param store: The data store holding the transform cache, or the default
+    store.
+    :return: The results of each candidate, best first: its classifier,
+    hyperparameters, fold accuracies, mean and standard deviation of accuracy,
+    and total fit and predict time. Also saved to `search.json`.
+    """
+    from sklearn.base import clone
+    from sklearn.model_selection import ParameterGrid, StratifiedKFold
+
+    if not make_data(dataset, transforms, bundled, store=store):
+        raise FileNotFoundError
+    images, labels = load_data(dataset, mmap=True)
+    splits = list(StratifiedKFold(folds, shuffle=True, random_state=seed)
+                  .split(np.zeros(len(labels)), labels))
+    grid = [(classifier, params) for classifier, param_grid in candidates
+            for params in ParameterGrid(param_grid)]
+
+    start = time.perf_counter()
+    with span("model_search"):
+        scores = joblib.Parallel(n_jobs=n_jobs or lib.POOL_SIZE)(
+            joblib.delayed(_evaluate_candidate)(classifier, params, images,
+                                                labels, train, test)
+            for classifier, params in grid for train, test in splits)
+    print(f"Evaluated {len(grid)} candidates in "
+          f"{time.perf_counter() - start:.1f}s")
+
+    results = []
+    for i, (classifier, params) in enumerate(grid):
+        fold_scores = scores[i * folds:(i + 1) * folds]
+        accuracy = [a for a, _, _ in fold_scores]
+        results.append({
+            "Classifier": type(classifier).__name__,
+            "Params": {k: _jsonable(v) for k, v in params.items()},
+            "Scores": accuracy,
+            "Mean": float(np.mean(accuracy)),
+            "Std": float(np.std(accuracy)),
+            "FitSeconds": sum(f for _, f, _ in fold_scores),
+            "PredictSeconds": sum(p for _, _, p in fold_scores),
+            "_index": i
+        })
+    results.sort(key=lambda r: -r["Mean"])
+    for r in results:
+        print(f"{r['Mean']:.3f} +/- {r['Std']:.3f}  fit "
+              f"{r['FitSeconds']:7.2f}s  predict {r['PredictSeconds']:6.2f}s"
+              f"  {r['Classifier']} {r['Params']}")
+
+    # Refit the best candidate on the whole dataset
+    classifier, params = grid[results[0]["_index"]]
+    best = clone(classifier).set_params(**params)
+    with span("fit"):
+        best.fit(images[:], labels)
+    joblib.dump(best, f"{dataset}/model.joblib")
+    for r in results:
+        del r["_index"]
+    with open(f"{dataset}/search.json", "w+") as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+def load_and_predict(model_dataset: str, test_dataset: str,
+                     mmap: bool = True,
+                     store: Optional[DataStore] = None) -> None:
     """
     Loads a model from one dataset and tests it on another. Overwrites the
     data numpy files of the test dataset.
@@ -46,59 +315,172 @@ def load_and_predict(model_dataset: str, test_dataset: str) -> None:
     duplication if necessary.
     :param model_dataset: The dataset from which the model comes from.
     :param test_dataset: The dataset to test on.
+    :param mmap: Whether to memory-map the test data and predict in batches,
+    allowing test datasets larger than memory.
+    :param store: The data store holding the transform cache, or the default
+    store.
     :return: None.
     """
     print("Loading model")
     classifier = joblib.load(f"{model_dataset}/model.joblib")
     print("Formatting data")
     p = get_process(model_dataset)
-    make_data(test_dataset, p["Transforms"], p["Bundled"])
-    images, labels = np.load(f"{test_dataset}/X.npy"), np.load(
-        f"{test_dataset}/Y.npy")
+    make_data(test_dataset, p["Transforms"], p["Bundled"], store=store)
+    images, labels = load_data(test_dataset, mmap)
     print("Starting classifier")
-    pred = classifier.predict(images)
-    print(classification_report(labels, pred))
-    print(pd.DataFrame(confusion_matrix(labels, pred)))
+    pred = batched_predict(classifier, images)
+    print_report(labels, pred)
+
+
+def _copy_with_checksum(src: str, dest: str) -> str:
+    """
+    Copies a file, hashing its content on the way.
+    :param src: The file to copy.
+    :param dest: The path to copy to.
+    :return: The SHA-256 hex digest of the content.
+    """
+    digest = hashlib.sha256()
+    with open(src, "rb") as fin, open(dest, "wb") as fout:
+        for chunk in iter(lambda: fin.read(EXPORT_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            fout.write(chunk)
+    return digest.hexdigest()
+
+
+def _file_checksum(fp: str) -> str:
+    """
+    Hashes the content of a file.
+    :param fp: The file.
+    :return: The SHA-256 hex digest of the content.
+    """
+    digest = hashlib.sha256()
+    with open(fp, "rb") as f:
+        for chunk in iter(lambda: f.read(EXPORT_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def export_model(model_dataset: str, dest: str) -> str:
+def export_model(model_dataset: str, dest: str, compress: int = 0) -> str:
     """
-    Exports a model with associated process to a given location.
+    Exports a model with associated process to a given location. The export
+    is a directory holding the model file and an `export.json` manifest with
+    the format version, process, compression level and checksum of the model.
+    Uncompressed models are copied as saved by `train_and_save`, and can be
+    memory-mapped when loaded with `load_exported_model`.
     :param model_dataset: The path to the model to export.
     :param dest: The destination directory.
-    :return: The path to the exported model.
+    :param compress: A joblib compression level from 0 to 9. Compressed
+    models are smaller but cannot be memory-mapped.
+    :return: The path to the exported model's manifest.
     """
-    try:
-        os.makedirs(dest)
-    except FileExistsError:
-        pass
+    os.makedirs(dest, exist_ok=True)
 
-    classifier = joblib.load(f"{model_dataset}/model.joblib")
-    process = get_process(model_dataset)
-    output = f"{dest}/export_model.joblib"
-    joblib.dump((process, classifier), output)
+    # Write to temporary files and rename them into place, manifest last, so
+    # that a concurrent reader never sees a partial export
+    tmp = f"{dest}/model.joblib.{uuid.uuid4().hex}.tmp"
+    try:
+        if compress:
+            classifier = joblib.load(f"{model_dataset}/model.joblib")
+            joblib.dump(classifier, tmp, compress=compress)
+            checksum = _file_checksum(tmp)
+        else:
+            checksum = _copy_with_checksum(f"{model_dataset}/model.joblib",
+                                           tmp)
+        os.replace(tmp, f"{dest}/model.joblib")
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    manifest = {
+        "Version": EXPORT_VERSION,
+        "Process": get_process(model_dataset),
+        "Model": "model.joblib",
+        "Compress": compress,
+        "Checksum": f"sha256:{checksum}"
+    }
+    output = f"{dest}/export.json"
+    with open(f"{output}.tmp", "w+") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{output}.tmp", output)
     return output
 
 
-def end_to_end_prediction(exported_model: str, image_paths: List[str]) \
+def load_exported_model(exported_model: str, mmap: bool = True,
+                        verify: bool = False) \
+        -> Tuple[Dict[str, Any], "ClassifierMixin"]:
+    """
+    Loads a model exported with `export_model`.
+    :param exported_model: The manifest or directory of the export, or a
+    `(process, classifier)` joblib file from before export versioning.
+    :param mmap: Whether to memory-map the arrays of uncompressed models
+    instead of reading them into memory, so that loading is fast and
+    processes loading the same model share its pages.
+    :param verify: Whether to check the model file against its checksum,
+    which requires reading the whole file.
+    :return: The process the model was trained with and the classifier.
+    """
+    if os.path.isdir(exported_model):
+        exported_model = f"{exported_model}/export.json"
+    if not exported_model.endswith(".json"):
+        return joblib.load(exported_model)
+    with open(exported_model, "r") as f:
+        manifest = json.load(f)
+    if manifest["Version"] > EXPORT_VERSION:
+        raise ValueError(f"Unsupported export version {manifest['Version']}")
+    model = f"{os.path.dirname(exported_model)}/{manifest['Model']}"
+    if verify:
+        checksum = f"sha256:{_file_checksum(model)}"
+        if checksum != manifest["Checksum"]:
+            raise ValueError(f"Checksum mismatch for {model}")
+    mode = "r" if mmap and not manifest["Compress"] else None
+    return manifest["Process"], joblib.load(model, mmap_mode=mode)
+
+
+def decode_predictions(process: Dict[str, Any], pred: np.ndarray) \
         -> List[str]:
     """
+    Converts classifier output to class names.
+    :param process: The process the classifier was trained with.
+    :param pred: The predicted class values.
+    :return: The predicted class names.
+    """
+    if process["Bundled"]:
+        return np.where(pred, "Graph", "NotGraph").tolist()
+    else:
+        return decode_labels(pred, process.get("Classes")).tolist()
+
+
+def end_to_end_prediction(exported_model: str, image_paths: List[str],
+                          in_memory: bool = False,
+                          store: Optional[DataStore] = None) -> List[str]:
+    """
     Loads the exported model and process, converts the given images to a
     dataset with the same process, classifies the images, deletes the dataset,
     and returns the result.
-    :param exported_model: A model exported with `export_model`.
+    :param exported_model: A model exported with `export_model`, as accepted
+    by `load_exported_model`.
     :param image_paths: Paths to image
-    :return:
+    :param in_memory: Whether to process the images in memory instead of
+    through a temporary dataset. Produces the same result without touching
+    the data store.
+    :param store: The data store to create the temporary dataset in, or the
+    default store.
+    :return: The predicted class names of the images.
     """
-    process, classifier = joblib.load(exported_model)
-    dataset = new_dataset(image_paths, process["Conversions"], from_store=False)
-    if not make_data(dataset, process["Transforms"], process["Bundled"]):
-        raise FileNotFoundError
-    images = np.load(f"{dataset}/X.npy")
-    pred = classifier.predict(images)
-    delete_dataset(dataset)
-    if process["Bundled"]:
-        return ["Graph" if p else "NotGraph" for p in pred]
+    process, classifier = load_exported_model(exported_model)
+    if in_memory:
+        images = load_images(image_paths, process["Conversions"],
+                             process["Transforms"])
     else:
-        return [list(CLASSES.keys())[list(CLASSES.values()).index(p)]
-                for p in pred]
+        dataset = new_dataset(image_paths, process["Conversions"],
+                              from_store=False, store=store)
+        try:
+            if not make_data(dataset, process["Transforms"],
+                             process["Bundled"], cache=False, store=store):
+                raise FileNotFoundError
+            images = np.load(f"{dataset}/X.npy")
+        finally:
+            delete_dataset(dataset)
+    with span("predict"):
+        pred = classifier.predict(images)
+    return decode_predictions(process, pred)
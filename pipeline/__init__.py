@@ -1,3 +1,17 @@
-from .store import init_data_store
+"""
+The image pipeline. Importing the package has no side effects; the data store
+is created by `pipeline.store.init_data_store`, or on first use.
+"""
 
-init_data_store()
+
+def __getattr__(name: str):
+    """
+    Imports `init_data_store` on first access, so that importing the package
+    does not import the store and its dependencies.
+    :param name: The attribute name.
+    :return: The attribute.
+    """
+    if name == "init_data_store":
+        from .store import init_data_store
+        return init_data_store
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,230 @@
+"""
+A content-addressed cache of transformed image arrays, used by `make_data` to
+avoid re-decoding and re-transforming images it has already processed.
+
+Entries are keyed by the content hash of the image file, the conversions and
+transforms applied, and PIPELINE_VERSION, so changing any of these results in
+a cache miss. Entries are stored as individual numpy files whose modification
+times record their last use, and the least recently used entries are evicted
+as the cache grows beyond CACHE_SIZE bytes. The cache is kept in the `cache`
+directory of a data store.
+"""
+import hashlib
+import json
+import os
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .context import DataStore, get_store
+
+# Maximum total size of cache entries in bytes
+CACHE_SIZE = 2 * 1024 ** 3
+
+# Fraction of CACHE_SIZE the cache is trimmed to when an entry does not fit,
+# so that the cache is not scanned again for every entry written once full
+EVICT_TARGET = 0.9
+
+# Version of the image processing code, to be bumped whenever a conversion or
+# transform changes its output so that stale entries are not reused
+PIPELINE_VERSION = 1
+
+_stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def content_hash(data: bytes) -> str:
+    """
+    Hashes the content of a file.
+    :param data: The file content.
+    :return: The hex digest of the content.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(digest: str, conversions: List[str],
+              transforms: List[str]) -> str:
+    """
+    Computes the cache key of a processed image.
+    :param digest: The content hash of the image file.
+    :param conversions: The conversions applied to the image.
+    :param transforms: The transforms applied to the image.
+    :return: The cache key.
+    """
+    key = json.dumps([digest, conversions, transforms, PIPELINE_VERSION])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def load_cached(key: str, store: Optional[DataStore] = None) \
+        -> Optional[np.ndarray]:
+    """
+    Loads a cache entry and marks it as recently used.
+    :param key: The cache key.
+    :param store: The data store, or the default store.
+    :return: The cached array, or None if there is no valid entry.
+    """
+    path = f"{get_store(store).cache}/{key}.npy"
+    try:
+        arr = np.load(path)
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return arr
+
+
+def save_cached(key: str, arr: np.ndarray,
+                store: Optional[DataStore] = None) -> None:
+    """
+    Saves a cache entry. Safe to call concurrently for the same key.
+    :param key: The cache key.
+    :param arr: The array to cache.
+    :param store: The data store, or the default store.
+    :return: None.
+    """
+    cache_dir = get_store(store).cache
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{cache_dir}/{key}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp, f"{cache_dir}/{key}.npy")
+
+
+def record_stats(hits: int, misses: int) -> None:
+    """
+    Adds to the hit and miss counters.
+    :param hits: The number of cache hits.
+    :param misses: The number of cache misses.
+    :return: None.
+    """
+    _stats["hits"] += hits
+    _stats["misses"] += misses
+
+
+def cache_stats() -> Dict[str, int]:
+    """
+    Returns the cache counters of this process.
+    :return: An object of hit, miss and eviction counts.
+    """
+    return dict(_stats)
+
+
+def reset_stats() -> None:
+    """
+    Resets the cache counters of this process.
+    :return: None.
+    """
+    for k in _stats:
+        _stats[k] = 0
+
+
+def _entries(store: Optional[DataStore]) -> List[Tuple[str, os.stat_result]]:
+    """
+    Lists the cache entries.
+    :param store: The data store, or the default store.
+    :return: The path and stat of each entry.
+    """
+    try:
+        entries = [e for e in os.scandir(get_store(store).cache)
+                   if e.name.endswith(".npy")]
+    except FileNotFoundError:
+        return []
+    stats = []
+    for e in entries:
+        try:
+            stats.append((e.path, e.stat()))
+        except FileNotFoundError:  # Evicted concurrently
+            pass
+    return stats
+
+
+def _evict(max_size: int, store: Optional[DataStore]) -> Tuple[int, int]:
+    """
+    Removes least recently used entries until the cache fits in a size limit.
+    :param max_size: The size limit in bytes.
+    :param store: The data store, or the default store.
+    :return: The number of entries removed and the size of the remaining
+    entries in bytes.
+    """
+    stats = _entries(store)
+    total = sum(s.st_size for _, s in stats)
+    removed = 0
+    for path, s in sorted(stats, key=lambda x: x[1].st_mtime):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total -= s.st_size
+    _stats["evictions"] += removed
+    return removed, total
+
+
+def evict(max_size: Optional[int] = None,
+          store: Optional[DataStore] = None) -> int:
+    """
+    Removes least recently used entries until the cache fits in its size limit.
+    :param max_size: The size limit in bytes, defaulting to CACHE_SIZE.
+    :param store: The data store, or the default store.
+    :return: The number of entries removed.
+    """
+    return _evict(CACHE_SIZE if max_size is None else max_size, store)[0]
+
+
+def cache_size(store: Optional[DataStore] = None) -> int:
+    """
+    Measures the cache.
+    :param store: The data store, or the default store.
+    :return: The total size of the cache entries in bytes.
+    """
+    return sum(s.st_size for _, s in _entries(store))
+
+
+class CacheWriter:
+    """
+    Saves cache entries while keeping the cache within its size limit. The
+    size of the cache is measured once and then tracked as entries are
+    written, and least recently used entries are evicted down to EVICT_TARGET
+    of the limit whenever a new entry would not fit. Entries larger than the
+    limit are not saved.
+    """
+
+    def __init__(self, store: Optional[DataStore] = None,
+                 max_size: Optional[int] = None):
+        """
+        :param store: The data store, or the default store.
+        :param max_size: The size limit in bytes, defaulting to CACHE_SIZE.
+        """
+        self.store = get_store(store)
+        self.max_size = CACHE_SIZE if max_size is None else max_size
+        self.size = cache_size(self.store)
+
+    def save(self, key: str, arr: np.ndarray) -> bool:
+        """
+        Saves a cache entry, evicting other entries first if it does not fit.
+        :param key: The cache key.
+        :param arr: The array to cache.
+        :return: Whether the entry was saved.
+        """
+        if arr.nbytes > self.max_size:
+            return False
+        if self.size + arr.nbytes > self.max_size:
+            target = min(int(self.max_size * EVICT_TARGET),
+                         self.max_size - arr.nbytes)
+            self.size = _evict(target, self.store)[1]
+        save_cached(key, arr, self.store)
+        try:
+            self.size += os.path.getsize(f"{self.store.cache}/{key}.npy")
+        except FileNotFoundError:  # Evicted concurrently
+            pass
+        return True
+
+
+def clear_cache(store: Optional[DataStore] = None) -> None:
+    """
+    Removes all cache entries.
+    :param store: The data store, or the default store.
+    :return: None.
+    """
+    evict(0, store)
@@ -0,0 +1,93 @@
+"""
+The location of a data store on disk.
+
+A `DataStore` holds the root directory of a data store and derives the paths
+of its parts from it. Functions which read or write the store take an
+optional `store` argument, and use the default store when none is given. The
+default store is rooted at the PIPELINE_DATA_ROOT environment variable, or
+`data` relative to the working directory, and can be replaced with
+`set_default_store`.
+
+Several processes on one machine can share a store. The store must be on a
+local filesystem, as the metadata database uses SQLite's WAL mode, which does
+not work on network filesystems.
+"""
+import os
+from typing import Optional
+
+# Root directory of the default store, relative to the working directory
+DEFAULT_ROOT = "data"
+
+
+class DataStore:
+    """
+    The paths of a data store under a root directory.
+    """
+
+    def __init__(self, root: Optional[str] = None):
+        """
+        :param root: The root directory, defaulting to the PIPELINE_DATA_ROOT
+        environment variable or DEFAULT_ROOT.
+        """
+        self.root = root or os.environ.get("PIPELINE_DATA_ROOT", DEFAULT_ROOT)
+
+    @property
+    def images(self) -> str:
+        """
+        :return: The directory of images in the store.
+        """
+        return f"{self.root}/images"
+
+    @property
+    def datasets(self) -> str:
+        """
+        :return: The directory of datasets.
+        """
+        return f"{self.root}/datasets"
+
+    @property
+    def cache(self) -> str:
+        """
+        :return: The directory of the transform cache.
+        """
+        return f"{self.root}/cache"
+
+    @property
+    def db(self) -> str:
+        """
+        :return: The path to the metadata database.
+        """
+        return f"{self.root}/store.db"
+
+    @property
+    def log(self) -> str:
+        """
+        :return: The path to the metadata CSV used before the database.
+        """
+        return f"{self.root}/log.csv"
+
+    def __repr__(self) -> str:
+        return f"DataStore({self.root!r})"
+
+
+_default: Optional[DataStore] = None
+
+
+def set_default_store(store: Optional[DataStore]) -> None:
+    """
+    Sets the store used when none is given.
+    :param store: The store, or None to use the PIPELINE_DATA_ROOT environment
+    variable or DEFAULT_ROOT again.
+    :return: None.
+    """
+    global _default
+    _default = store
+
+
+def get_store(store: Optional[DataStore] = None) -> DataStore:
+    """
+    Resolves an optional store argument.
+    :param store: The store given, if any.
+    :return: The given store, or the default store.
+    """
+    return store or _default or DataStore()
@@ -3,66 +3,97 @@ A set of tools to process image files. All conversions have the type
 `fp: str, dest: Optional[str] = None) -> str`.
 
 To add a conversion, add a function and then add a flag name to the CONVERSIONS
-global list.
+global list, along with an in-memory equivalent of type
+`(img: Image.Image) -> Image.Image` in the IMAGE_OPS global dictionary.
+
+Use `convert_chain` to apply several conversions at once. It decodes and
+encodes each image only once, so it should be preferred over calling the
+functions of CONVERSIONS in sequence.
 """
+import io
 import os
-from typing import Callable, Dict, Optional
+import uuid
+from typing import Callable, Dict, List, Optional
 
 from PIL import Image
 
+from .profiling import span
+
 # Scaling dimensions
 HEIGHT = 300
 WIDTH = 400
 
+# When scaling, large images are decoded at a reduced resolution of at least
+# DRAFT_QUALITY times HEIGHT x WIDTH before being resized, using JPEG DCT
+# scaling or Image.reduce. Higher values trade speed for fidelity to a full
+# resolution decode; 0 disables reduced decoding.
+DRAFT_QUALITY = 2
+
+# Formats which can be saved and reloaded without altering pixel data
+LOSSLESS_FORMATS = {"PNG", "BMP", "TIFF"}
+
+
+def _to_png(img: Image.Image) -> Image.Image:
+    """
+    In-memory equivalent of `convert_to_png`. PNG encoding is lossless, so the
+    pixel data is unchanged.
+    :param img: The image to convert.
+    :return: The same image.
+    """
+    return img
+
+
+def _to_grayscale(img: Image.Image) -> Image.Image:
+    """
+    In-memory equivalent of `make_grayscale`.
+    :param img: The image to convert.
+    :return: The single-channel grayscale image.
+    """
+    return img.convert("L")
+
+
+def _to_scaled(img: Image.Image) -> Image.Image:
+    """
+    In-memory equivalent of `scale_image`.
+    :param img: The image to convert.
+    :return: The image scaled to HEIGHT x WIDTH.
+    """
+    return img.resize((WIDTH, HEIGHT))
+
 
 def convert_to_png(fp: str, dest: Optional[str] = None) -> str:
     """
-    Converts an image to a PNG.
+    Converts an image to a PNG, replacing the original if no destination path
+    is specified.
     :param fp: The path to the image to convert.
     :param dest: A destination path, if a non-destructive operation is desired.
     :return: The path to the converted image.
     """
-    new_fp = dest or f"{'.'.join(fp.split('.')[:-1])}.png"
-
-    img = Image.open(fp)
-    img.load()  # Force loading of the image into memory
-    img.save(new_fp, format="png")
-    img.close()
-
-    if fp != new_fp:
-        os.remove(fp)
-
-    return new_fp
+    return convert_chain(fp, ["PNG"], dest)
 
 
 def make_grayscale(fp: str, dest: Optional[str] = None) -> str:
     """
-    Converts an image to single-channel grayscale. In-place if no destination
-    path is specified.
+    Converts an image to single-channel grayscale. Replaces the image if no
+    destination path is specified, writing a new file so that files
+    hard-linked to it are left unchanged.
     :param fp: The image to convert.
     :param dest: A destination path, if a non-destructive operation is desired.
     :return: The path to the new image.
     """
-    img = Image.open(fp)
-    img = img.convert("L")
-    new_path = dest or fp
-    img.save(new_path)
-    return new_path
+    return convert_chain(fp, ["Grayscale"], dest)
 
 
 def scale_image(fp: str, dest: Optional[str] = None) -> str:
     """
     Scales an image to HEIGHT x WIDTH, the standard size used by the pipeline
-    for modelling.
+    for modelling. Replaces the image if no destination path is specified,
+    writing a new file so that files hard-linked to it are left unchanged.
     :param fp: The image to convert.
     :param dest: A destination path, if a non-destructive operation is desired.
     :return: The path to the new image.
     """
-    img = Image.open(fp)
-    img = img.resize((WIDTH, HEIGHT))
-    new_path = dest or fp
-    img.save(new_path)
-    return new_path
+    return convert_chain(fp, ["Size Scaled"], dest)
 
 
 # List of available conversions
@@ -71,3 +102,135 @@ CONVERSIONS: Dict[str, Callable[[str, Optional[str]], str]] = {
     "Grayscale": make_grayscale,
     "Size Scaled": scale_image
 }
+
+# In-memory equivalents of the available conversions
+IMAGE_OPS: Dict[str, Callable[[Image.Image], Image.Image]] = {
+    "PNG": _to_png,
+    "Grayscale": _to_grayscale,
+    "Size Scaled": _to_scaled
+}
+
+
+def get_format(fp: str) -> Optional[str]:
+    """
+    Gets the format PIL would use when saving to the given path.
+    :param fp: The path to an image.
+    :return: The PIL format name, if the extension is known.
+    """
+    return Image.registered_extensions().get(os.path.splitext(fp)[1].lower())
+
+
+def _reencode(img: Image.Image, fmt: Optional[str]) -> Image.Image:
+    """
+    Emulates saving an image to disk in the given format and reading it back.
+    :param img: The image to re-encode.
+    :param fmt: The format the image would be saved in.
+    :return: The image as it would be read back from disk.
+    """
+    if fmt is None or fmt in LOSSLESS_FORMATS:
+        return img
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt)
+    buffer.seek(0)
+    reloaded = Image.open(buffer)
+    reloaded.load()
+    return reloaded
+
+
+def _reduce_for_scaling(img: Image.Image, conversions: List[str]) \
+        -> Image.Image:
+    """
+    Prepares an opened image to be decoded at a reduced resolution if it will
+    be scaled down to HEIGHT x WIDTH. Must be called before the image is
+    loaded. All other conversions are applied per pixel, so reducing the image
+    first only affects the result through the resampling used.
+    :param img: The opened image.
+    :param conversions: The conversions to be applied.
+    :return: The image to apply the conversions to.
+    """
+    if not DRAFT_QUALITY or "Size Scaled" not in conversions:
+        return img
+    target = (WIDTH * DRAFT_QUALITY, HEIGHT * DRAFT_QUALITY)
+    if img.format == "JPEG":
+        img.draft(img.mode, target)
+        return img
+    factor = min(img.width // target[0], img.height // target[1])
+    if factor >= 2 and img.mode in ("L", "RGB", "RGBA", "LA", "I", "F"):
+        return img.reduce(factor)
+    return img
+
+
+def converted_path(fp: str, conversions: List[str]) -> str:
+    """
+    Gets the path an image ends up at after a series of conversions.
+    :param fp: The path to the image before conversion.
+    :param conversions: The list of conversions to apply.
+    :return: The path to the converted image.
+    """
+    if "PNG" in conversions:
+        return f"{'.'.join(fp.split('.')[:-1])}.png"
+    return fp
+
+
+def convert_chain(fp: str, conversions: List[str],
+                  dest: Optional[str] = None) -> str:
+    """
+    Applies a series of conversions to an image file in a single pass,
+    decoding the image once and encoding it once. Equivalent to applying the
+    functions of CONVERSIONS in order, except that lossy formats are not
+    re-encoded between conversions.
+    :param fp: The path to the image to convert.
+    :param conversions: The list of conversions to apply.
+    :param dest: A destination path, if a non-destructive operation is desired.
+    Used as given, so it should already carry the final file extension.
+    :return: The path to the converted image.
+    """
+    if not conversions:
+        return fp
+    new_fp = dest or converted_path(fp, conversions)
+
+    with span("decode"):
+        img = _reduce_for_scaling(Image.open(fp), conversions)
+        img.load()  # Force loading, as the source may be overwritten
+    for c in conversions:
+        with span(f"conversion:{c}"):
+            img = IMAGE_OPS[c](img)
+    # Write to a new file and rename it into place, so that files hard-linked
+    # to the original are left unchanged
+    tmp = f"{new_fp}.{uuid.uuid4().hex}.tmp"
+    try:
+        with span("encode"):
+            img.save(tmp, format=get_format(new_fp))
+        os.replace(tmp, new_fp)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        img.close()
+
+    if dest is None and fp != new_fp:
+        os.remove(fp)
+
+    return new_fp
+
+
+def convert_in_memory(img: Image.Image, conversions: List[str],
+                      fmt: Optional[str]) -> Image.Image:
+    """
+    Applies a series of conversions to a decoded image without touching disk,
+    producing the same pixel data as `convert_chain`.
+    :param img: The opened image, which should not yet be loaded so that it
+    can be decoded at a reduced resolution.
+    :param conversions: The list of conversions to apply.
+    :param fmt: The format of the file the image was decoded from.
+    :return: The converted image.
+    """
+    if not conversions:
+        return img
+    img = _reduce_for_scaling(img, conversions)
+    for c in conversions:
+        with span(f"conversion:{c}"):
+            img = IMAGE_OPS[c](img)
+    with span("reencode"):
+        return _reencode(img, "PNG" if "PNG" in conversions else fmt)
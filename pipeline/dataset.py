@@ -1,45 +1,130 @@
 """
 Functions for manipulating datasets.
 """
-import itertools
+import io
 import os
 import shutil
-from typing import List, Dict, Any
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import json
 
 import numpy as np
-import pandas as pd
+from numpy.lib import format as npy_format
+from numpy.lib.format import open_memmap
 from PIL import Image
 
-from .conversions import CONVERSIONS
+from .cache import CacheWriter, cache_key, content_hash, load_cached, \
+    record_stats
+from .context import DataStore, get_store
+from .conversions import convert_chain, convert_in_memory, converted_path, \
+    get_format
 from .lib import process_map
-from .transforms import TRANSFORMS
-from .store import CLASSES, DEFAULT_CLASS
+from .metadata import select_images
+from .profiling import count, span, traced
+from .shards import ShardReader, ShardWriter, is_packed
+from .transforms import TRANSFORMS, apply_batch_transforms
+from .store import DEFAULT_CLASS, encode_labels
 
+# Number of images held in memory at once while building X.npy
+CHUNK_SIZE = 256
 
+
+def _copy_and_apply(file: str, dataset: str,
+                    conversions_to_apply: List[str]) -> str:
+    """
+    Copies a file to a dataset and applies conversions. Files without
+    conversions to apply are hard-linked where possible instead of copied.
+    :param file: The file to copy and process.
+    :param dataset: The dataset to copy the file to.
+    :param conversions_to_apply: The conversions to apply after copying.
+    :return: The path to the copied file.
+    """
+    img = f"{dataset}/images/{os.path.basename(file)}"
+    if not conversions_to_apply:
+        with span("link"):
+            try:
+                os.link(file, img)
+            except OSError:  # Unsupported, or across file systems
+                shutil.copyfile(file, img)
+        return img
+    return convert_chain(file, conversions_to_apply,
+                         converted_path(img, conversions_to_apply))
+
+
+def _write_shards(dataset: str,
+                  conversions_left: List[Tuple[Dict[str, Any], List[str]]]) \
+        -> None:
+    """
+    Decodes and converts images in memory and writes them to the shards of a
+    packed dataset, holding at most CHUNK_SIZE images in memory at once.
+    :param dataset: The dataset to write to.
+    :param conversions_left: The metadata row of each image with the
+    conversions it still needs.
+    :return: None.
+    """
+    writer = ShardWriter(dataset, len(conversions_left))
+    for start in range(0, len(conversions_left), CHUNK_SIZE):
+        chunk = conversions_left[start:start + CHUNK_SIZE]
+        arrs = process_map(_load_data,
+                           [(r["File"], cs, []) for r, cs in chunk],
+                           packed=True)
+        for arr, (r, _) in zip(arrs, chunk):
+            writer.write(arr, r["Class"])
+    writer.close()
+
+
+def _allocate_dataset(store: DataStore) -> str:
+    """
+    Creates a new, empty dataset folder. Each folder is claimed by creating
+    it, which is atomic, so concurrent jobs sharing a store never receive the
+    same folder.
+    :param store: The data store.
+    :return: The path to the dataset folder.
+    """
+    os.makedirs(store.datasets, exist_ok=True)
+    taken = set(os.listdir(store.datasets))
+    i = 0
+    while True:
+        if f"dataset-{i}" not in taken:
+            try:
+                os.mkdir(f"{store.datasets}/dataset-{i}")
+                return f"{store.datasets}/dataset-{i}"
+            except FileExistsError:  # Claimed by a concurrent job
+                pass
+        i += 1
+
+
+@traced("new_dataset")
 def new_dataset(filenames: List[str], conversions: List[str],
-                from_store=True) -> str:
+                from_store=True, packed: bool = False,
+                store: Optional[DataStore] = None,
+                classes: Optional[Dict[str, int]] = None) -> str:
     """
     Create a new dataset from a set of files and conversions.
     :param filenames: The list of files to import.
     :param conversions: The list of conversions to apply.
     :param from_store: Whether the images are from the store.
+    :param packed: Whether to store the images in the packed shard format of
+    `shards.py` rather than as individual files. All converted images must
+    then have the same shape.
+    :param store: The data store to create the dataset in, or the default
+    store.
+    :param classes: The ID of each class name, to be used instead of CLASSES
+    when encoding labels. Saved as Classes in process.json.
     :return: The path to the dataset folder.
     """
     # Create new dataset
-    datasets = os.listdir("data/datasets")
-    i = next(i for i in itertools.count() if f"dataset-{i}" not in datasets)
-    dataset = f"data/datasets/dataset-{i}"
-    os.mkdir(dataset)
-    os.mkdir(f"{dataset}/images")
+    store = get_store(store)
+    dataset = _allocate_dataset(store)
+    if not packed:
+        os.mkdir(f"{dataset}/images")
     with open(f"{dataset}/process.json", "w+") as f:
         json.dump(
-            {"Conversions": conversions, "Transforms": [], "Bundled": None}, f)
+            {"Conversions": conversions, "Transforms": [], "Bundled": None,
+             "Classes": classes}, f)
 
     # Add images
     if from_store:
-        df_store = pd.read_csv("data/log.csv", index_col="Index")
-        df = df_store[[f in filenames for f in df_store["File"]]]
+        df = select_images(filenames, store=store)
         conversions_left = [
             (r, [c for c in conversions if not r[c]])
             for _, r in df.iterrows()
@@ -48,26 +133,20 @@ def new_dataset(filenames: List[str], conversions: List[str],
         conversions_left = [({"File": f, "Class": DEFAULT_CLASS}, conversions)
                             for f in filenames]
 
-    def _copy_and_apply(file: str, conversions_to_apply: List[str]) -> str:
-        """
-        Copies a file to a dataset and applies conversions.
-        :param file: The file to copy and process.
-        :param conversions_to_apply: The conversions to apply after copying.
-        :return: None.
-        """
-        img = f"{dataset}/images/{os.path.basename(file)}"
-        shutil.copyfile(file, img)
-        for c in conversions_to_apply:
-            img = CONVERSIONS[c](img)
-        return img
-
-    new_images = process_map(_copy_and_apply,
-                             [(r["File"], cs) for r, cs in conversions_left],
-                             packed=True)
+    if packed:
+        _write_shards(dataset, conversions_left)
+        new_images = [r["File"] for r, _ in conversions_left]
+    else:
+        new_images = process_map(_copy_and_apply,
+                                 [(r["File"], dataset, cs)
+                                  for r, cs in conversions_left],
+                                 packed=True)
+    import pandas as pd
     new_data = [(new, r["Class"]) for new, (r, _)
                 in zip(new_images, conversions_left)]
     new_df = pd.DataFrame(new_data, columns=["File", "Class"])
-    new_df.to_csv(f"{dataset}/log.csv", index_label="Index")
+    with span("log:write"):
+        new_df.to_csv(f"{dataset}/log.csv", index_label="Index")
     return dataset
 
 
@@ -80,43 +159,351 @@ def delete_dataset(dataset: str) -> None:
     shutil.rmtree(dataset)
 
 
-def _load_image_array(fp: str) -> np.ndarray:
+def image_to_data(img: Image.Image, conversions: List[str],
+                  transforms: List[str], fmt: Optional[str] = None) \
+        -> np.ndarray:
+    """
+    Converts a single decoded image into model input data, applying
+    conversions and transforms in memory.
+    :param img: The decoded image.
+    :param conversions: The list of conversions to apply.
+    :param transforms: The list of transforms to apply.
+    :param fmt: The format the image was encoded in, if not set on the image.
+    :return: The image data, as would be saved as a row of X.npy.
+    """
+    img = convert_in_memory(img, conversions, fmt or img.format)
+    with span("decode"):
+        arr = np.array(img)
+    for f in transforms:
+        with span(f"transform:{f}"):
+            arr = TRANSFORMS[f](arr)
+    return arr
+
+
+def _load_data(fp: str, conversions: List[str],
+               transforms: List[str]) -> np.ndarray:
     """
-    Converts an image on disk to a numpy array.
-    :param fp: The image to convert.
-    :return: The image data as a numpy array.
+    Loads an image from disk into model input data, applying conversions and
+    transforms in memory.
+    :param fp: The image to load.
+    :param conversions: The list of conversions to apply.
+    :param transforms: The list of transforms to apply.
+    :return: The image data, as would be saved as a row of X.npy.
     """
     img = Image.open(fp)
-    arr = np.array(img)
+    arr = image_to_data(img, conversions, transforms, get_format(fp))
     img.close()
     return arr
 
 
-def _make_imageset(dataset: str, transforms: List[str]) -> bool:
+@traced("load_images")
+def load_images(fps: List[str], conversions: List[str],
+                transforms: List[str]) -> np.ndarray:
+    """
+    Loads a set of images into model input data without creating a dataset,
+    applying conversions and transforms in memory.
+    :param fps: The paths to the images to load.
+    :param conversions: The list of conversions to apply.
+    :param transforms: The list of transforms to apply.
+    :return: The image data, as would be saved to X.npy by `make_data`.
+    """
+    images = process_map(_load_data, [(fp, conversions, []) for fp in fps],
+                         packed=True)
+    return apply_batch_transforms(np.array(images), transforms)
+
+
+def _load_cached_data(fp: str, conversions: List[str],
+                      transforms: List[str], store: DataStore) \
+        -> Tuple[np.ndarray, Optional[str]]:
+    """
+    Loads an already converted image, looking up its transformed data in the
+    transform cache.
+    :param fp: The image to load.
+    :param conversions: The conversions which were applied to the image.
+    :param transforms: The list of transforms to apply.
+    :param store: The data store holding the transform cache.
+    :return: The transformed image data and None if it was found in the
+    cache, otherwise the untransformed image data and the cache key to store
+    the transformed data under.
+    """
+    with open(fp, "rb") as f:
+        content = f.read()
+    key = cache_key(content_hash(content), conversions, transforms)
+    arr = load_cached(key, store)
+    if arr is not None:
+        return arr, None
+    img = Image.open(io.BytesIO(content))
+    arr = image_to_data(img, [], [], get_format(fp))
+    img.close()
+    return arr, key
+
+
+def _fingerprint(fp: str, conversions: List[str],
+                 transforms: List[str]) -> str:
+    """
+    Computes a fingerprint identifying the row of X.npy an image produces,
+    from the image path, size and modification time and the process applied.
+    :param fp: The image.
+    :param conversions: The conversions which were applied to the image.
+    :param transforms: The transforms applied to the image.
+    :return: The fingerprint.
+    """
+    st = os.stat(fp)
+    return cache_key(f"{fp}:{st.st_size}:{st.st_mtime_ns}", conversions,
+                     transforms)
+
+
+def _load_previous(dataset: str) \
+        -> Tuple[Optional[np.ndarray], Dict[str, int]]:
+    """
+    Loads an existing X.npy of a dataset along with the fingerprints of its
+    rows.
+    :param dataset: The dataset.
+    :return: The memory-mapped image data and a mapping from fingerprints to
+    row indices, or None and an empty mapping if either is missing or they do
+    not match.
+    """
+    try:
+        fingerprints = np.load(f"{dataset}/fingerprints.npy")
+        old = np.load(f"{dataset}/X.npy", mmap_mode="r")
+    except (OSError, ValueError):
+        return None, {}
+    if len(old) != len(fingerprints):
+        return None, {}
+    return old, {f: i for i, f in enumerate(fingerprints)}
+
+
+def _reusable_in_place(old: Optional[np.ndarray],
+                       old_rows: List[Optional[int]]) -> bool:
+    """
+    Checks whether a previous X.npy can be updated in place: every reused
+    row must already be at its position, and rows past the end of the old
+    data must all be new.
+    :param old: The previous image data, if any.
+    :param old_rows: For each image, its row in the previous image data, or
+    None if it must be processed.
+    :return: Whether the reused rows form an in-order prefix of the old data.
+    """
+    if old is None:
+        return False
+    if any(r not in (i, None) for i, r in enumerate(old_rows[:len(old)])):
+        return False
+    return any(r is not None for r in old_rows) and \
+        all(r is None for r in old_rows[len(old):])
+
+
+def _resize_rows(fp: str, n: int) -> Optional[np.ndarray]:
+    """
+    Changes the number of rows of a numpy file in place, keeping the rows
+    before the new end and extending the file for any rows added.
+    :param fp: The numpy file.
+    :param n: The new number of rows.
+    :return: The file memory-mapped for writing, or None if the file is left
+    unchanged because its header cannot be rewritten at the same length.
+    """
+    writers = {(1, 0): (npy_format.read_array_header_1_0,
+                        npy_format.write_array_header_1_0),
+               (2, 0): (npy_format.read_array_header_2_0,
+                        npy_format.write_array_header_2_0)}
+    with open(fp, "r+b") as f:
+        version = npy_format.read_magic(f)
+        if version not in writers:
+            return None
+        read_header, write_header = writers[version]
+        shape, fortran, dtype = read_header(f)
+        offset = f.tell()
+        if fortran or not shape:
+            return None
+        header = io.BytesIO()
+        write_header(header, {"descr": npy_format.dtype_to_descr(dtype),
+                              "fortran_order": False,
+                              "shape": (n, *shape[1:])})
+        if header.tell() != offset:
+            return None
+        size = offset + n * int(np.prod(shape[1:])) * dtype.itemsize
+        f.seek(0)
+        f.write(header.getvalue())
+        f.truncate(size)
+    return open_memmap(fp, mode="r+")
+
+
+def _write_imageset(fp: str, fps: List[str], conversions: List[str],
+                    transforms: List[str], cache: bool = True,
+                    old: Optional[np.ndarray] = None,
+                    old_rows: Optional[List[Optional[int]]] = None,
+                    store: Optional[DataStore] = None,
+                    in_place: bool = False) -> None:
+    """
+    Streams images through a series of transforms into a memory-mapped numpy
+    file, holding at most CHUNK_SIZE images in memory at once. Images are
+    decoded in parallel and transformed a chunk at a time with the batch
+    transforms. All transformed images must have the same shape and type. Rows
+    of a previous version of the file can be reused instead of reprocessing
+    their images.
+    :param fp: The numpy file to write.
+    :param fps: The paths to the images to load.
+    :param conversions: The conversions which were applied to the images.
+    :param transforms: A list of transform functions to apply when loading.
+    :param cache: Whether to use the transform cache.
+    :param old: The previous image data, if any.
+    :param old_rows: For each image, its row in the previous image data, or
+    None if it must be processed.
+    :param store: The data store holding the transform cache, or the default
+    store.
+    :param in_place: Whether `old` is the file being written, already resized
+    to the new number of rows, with every reused row at its own position.
+    Only the rows which must be processed are then written.
+    :return: None.
+    """
+    store = get_store(store)
+    old_rows = old_rows or [None] * len(fps)
+    writer = CacheWriter(store) if cache else None
+    out = None
+    if in_place:
+        out = old
+    elif any(r is not None for r in old_rows):
+        out = open_memmap(fp, mode="w+", dtype=old.dtype,
+                          shape=(len(fps), *old.shape[1:]))
+    for start in range(0, len(fps), CHUNK_SIZE):
+        rows = old_rows[start:start + CHUNK_SIZE]
+        todo = [i for i, r in enumerate(rows, start) if r is None]
+        if cache:
+            results = process_map(_load_cached_data,
+                                  [(fps[i], conversions, transforms, store)
+                                   for i in todo], packed=True)
+        else:  # Without the cache, every image is a miss
+            results = [(arr, "") for arr in process_map(
+                _load_data, [(fps[i], [], []) for i in todo], packed=True)]
+        hits = [(i, arr) for i, (arr, key) in zip(todo, results)
+                if key is None]
+        misses = [(i, arr, key) for i, (arr, key) in zip(todo, results)
+                  if key is not None]
+        if cache:
+            record_stats(len(hits), len(misses))
+        count("rows_reused", len(rows) - len(todo))
+
+        # Transform the images not found in the cache as one block, directly
+        # into the output file when they make up the whole chunk
+        transformed = None
+        if misses:
+            block = np.stack([arr for _, arr, _ in misses])
+            contiguous = out is not None and len(misses) == len(rows)
+            transformed = apply_batch_transforms(
+                block, transforms,
+                out[start:start + len(rows)] if contiguous else None)
+            if writer is not None:
+                for (_, _, key), arr in zip(misses, transformed):
+                    writer.save(key, np.array(arr))
+        if out is None:
+            first = transformed[0] if transformed is not None else hits[0][1]
+            out = open_memmap(fp, mode="w+", dtype=first.dtype,
+                              shape=(len(fps), *first.shape))
+
+        if not in_place:
+            for i, r in enumerate(rows, start):
+                if r is not None:
+                    out[i] = old[r]
+        for i, arr in hits:
+            out[i] = arr
+        if transformed is not None and \
+                not np.may_share_memory(transformed, out):
+            out[[i for i, _, _ in misses]] = transformed
+    if out is None:
+        np.save(fp, np.array([]))
+    else:
+        out.flush()
+        del out
+
+
+def _write_packed_imageset(fp: str, reader: ShardReader,
+                           transforms: List[str]) -> None:
+    """
+    Streams the images of a packed dataset through a series of batch
+    transforms into a memory-mapped numpy file.
+    :param fp: The numpy file to write.
+    :param reader: The reader of the packed dataset.
+    :param transforms: A list of transform functions to apply.
+    :return: None.
+    """
+    out = None
+    i = 0
+    for block in reader.iter_chunks(CHUNK_SIZE):
+        if out is None:
+            first = apply_batch_transforms(block, transforms)
+            out = open_memmap(fp, mode="w+", dtype=first.dtype,
+                              shape=(len(reader), *first.shape[1:]))
+            out[:len(block)] = first
+        else:
+            apply_batch_transforms(block, transforms, out[i:i + len(block)])
+        i += len(block)
+    if out is None:
+        np.save(fp, np.array([]))
+    else:
+        out.flush()
+        del out
+
+
+@traced("make_imageset")
+def _make_imageset(dataset: str, transforms: List[str],
+                   cache: bool = True,
+                   store: Optional[DataStore] = None) -> bool:
     """
     Loads the images from dataset image store, applies a series of transforms,
-    and saves the result to the dataset.
+    and saves the result to the dataset. If X.npy already exists, only the
+    images whose fingerprints do not match one of its rows are processed.
+    Packed datasets are always processed in full.
     :param transforms: A list of transform functions to apply when loading.
     :param dataset: The path to the dataset.
+    :param cache: Whether to use the transform cache.
+    :param store: The data store holding the transform cache, or the default
+    store.
     :return: Whether the operation was successful.
     """
+    fingerprints = None
+    in_place = False
     try:
-        df = pd.read_csv(f"{dataset}/log.csv")
-        fps = list(df["File"])
-        images = process_map(_load_image_array, fps)
+        if is_packed(dataset):
+            _write_packed_imageset(f"{dataset}/X.tmp.npy",
+                                   ShardReader(dataset), transforms)
+        else:
+            fps = _dataset_files(dataset)
+            conversions = get_process(dataset)["Conversions"]
+            fingerprints = [_fingerprint(f, conversions, transforms)
+                            for f in fps]
+            old, old_index = _load_previous(dataset)
+            old_rows = [old_index.get(f) for f in fingerprints]
+            if _reusable_in_place(old, old_rows):
+                # The fingerprints are removed first, so that an interrupted
+                # update leads to a full rebuild rather than stale rows
+                del old
+                os.remove(f"{dataset}/fingerprints.npy")
+                old = _resize_rows(f"{dataset}/X.npy", len(fps))
+                in_place = old is not None
+                if not in_place:
+                    old = np.load(f"{dataset}/X.npy", mmap_mode="r")
+            _write_imageset(f"{dataset}/X.npy" if in_place
+                            else f"{dataset}/X.tmp.npy", fps, conversions,
+                            transforms, cache, old, old_rows, store, in_place)
+            del old
     except FileNotFoundError:
+        try:
+            os.remove(f"{dataset}/X.tmp.npy")
+        except FileNotFoundError:
+            pass
         return False
-    for f in transforms:
-        images = process_map(TRANSFORMS[f], images)
-    with open(f"{dataset}/process.json", "r") as f:
-        data = json.load(f)
-        data["Transforms"] = transforms
-    with open(f"{dataset}/process.json", "w+") as f:
-        json.dump(data, f)
-    np.save(f"{dataset}/X.npy", np.array(images))
+    if not in_place:
+        try:
+            os.remove(f"{dataset}/fingerprints.npy")
+        except FileNotFoundError:
+            pass
+        os.replace(f"{dataset}/X.tmp.npy", f"{dataset}/X.npy")
+    if fingerprints is not None:
+        np.save(f"{dataset}/fingerprints.npy", np.array(fingerprints))
+    _update_process(dataset, "Transforms", transforms)
     return True
 
 
+@traced("make_labelset")
 def _make_labelset(dataset: str, bundled: bool = True) -> bool:
     """
     Turns the labels of a dataset into training data labels, applying bundling
@@ -125,29 +512,119 @@ def _make_labelset(dataset: str, bundled: bool = True) -> bool:
     :param bundled: Whether the chart classes should be bundled.
     :return: Whether the operation was successful.
     """
-    df = pd.read_csv(f"{dataset}/log.csv")
-    classes = [int(bool(CLASSES[c])) if bundled else CLASSES[c] for c in
-               df["Class"]]
-    with open(f"{dataset}/process.json", "r") as f:
-        data = json.load(f)
-        data["Bundled"] = bundled
-    with open(f"{dataset}/process.json", "w+") as f:
-        json.dump(data, f)
-    np.save(f"{dataset}/Y.npy", np.array(classes))
+    import pandas as pd
+    with span("log:read"):
+        df = pd.read_csv(f"{dataset}/log.csv")
+    names = df["Class"].to_numpy(dtype=str)
+    classes = encode_labels(names, get_process(dataset).get("Classes"))
+    if bundled:
+        classes = (names != "NotGraph").astype(int)
+    _update_process(dataset, "Bundled", bundled)
+    np.save(f"{dataset}/Y.npy", classes)
     return True
 
 
 def make_data(dataset: str, transforms: List[str],
-              bundled: bool = True) -> bool:
+              bundled: bool = True, cache: bool = True,
+              store: Optional[DataStore] = None, images: bool = True) -> bool:
     """
     Construct X.npy and Y.npy dataset files.
     :param dataset: The dataset to convert.
     :param transforms: The list of transforms to apply to the images.
     :param bundled: Whether the label classes should be bundled.
+    :param cache: Whether to reuse and store transformed images in the
+    transform cache.
+    :param store: The data store holding the transform cache, or the default
+    store.
+    :param images: Whether to construct X.npy. Otherwise only Y.npy is
+    constructed and the transforms are recorded, for images to be streamed
+    from the dataset with `iter_batches`.
     :return: Whether the operation was successful.
     """
-    return _make_imageset(dataset, transforms) and \
-           _make_labelset(dataset, bundled)
+    # Bundling separates NotGraph from every other class, so it needs one
+    classes = get_process(dataset).get("Classes")
+    if bundled and classes is not None and "NotGraph" not in classes:
+        raise ValueError("Bundled labels need a NotGraph class, which the "
+                         "class set of the dataset does not have")
+    if images:
+        if not _make_imageset(dataset, transforms, cache, store):
+            return False
+    else:
+        _update_process(dataset, "Transforms", transforms)
+    return _make_labelset(dataset, bundled)
+
+
+def iter_batches(dataset: str, indices: np.ndarray, batch_size: int,
+                 transforms: Optional[List[str]] = None) \
+        -> Iterator[np.ndarray]:
+    """
+    Streams samples of a dataset in batches, holding one batch in memory at a
+    time.
+    :param dataset: The dataset.
+    :param indices: The indices of the samples, in the order to stream them.
+    :param batch_size: The number of samples per batch.
+    :param transforms: None to read rows of X.npy, memory-mapped. Otherwise
+    the dataset images are decoded and transformed with these transforms as
+    each batch is read, without needing X.npy.
+    :return: An iterator over the batches, matching
+    `indices[start:start + batch_size]` for each start.
+    """
+    if transforms is None:
+        images = np.load(f"{dataset}/X.npy", mmap_mode="r")
+        for start in range(0, len(indices), batch_size):
+            yield images[indices[start:start + batch_size]]
+    elif is_packed(dataset):
+        reader = ShardReader(dataset)
+        for start in range(0, len(indices), batch_size):
+            block = np.stack([reader[i]
+                              for i in indices[start:start + batch_size]])
+            yield apply_batch_transforms(block, transforms)
+    else:
+        files = _dataset_files(dataset)
+        for start in range(0, len(indices), batch_size):
+            yield load_images([files[i]
+                               for i in indices[start:start + batch_size]],
+                              [], transforms)
+
+
+def load_data(dataset: str, mmap: bool = True) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Loads the X.npy and Y.npy files of a dataset.
+    :param dataset: The dataset to load.
+    :param mmap: Whether to memory-map the files instead of reading them into
+    memory.
+    :return: The image data and labels of the dataset.
+    """
+    mode = "r" if mmap else None
+    return np.load(f"{dataset}/X.npy", mmap_mode=mode), \
+        np.load(f"{dataset}/Y.npy", mmap_mode=mode)
+
+
+def _dataset_files(dataset: str) -> List[str]:
+    """
+    Reads the image files of a dataset from its log.csv.
+    :param dataset: The dataset.
+    :return: The paths to the images, in dataset order.
+    """
+    import pandas as pd
+    with span("log:read"):
+        df = pd.read_csv(f"{dataset}/log.csv")
+    return list(df["File"])
+
+
+def _update_process(dataset: str, key: str, value: Any) -> None:
+    """
+    Sets a value in the process metadata of a dataset.
+    :param dataset: The dataset.
+    :param key: The key to set.
+    :param value: The value to set.
+    :return: None.
+    """
+    data = get_process(dataset)
+    data[key] = value
+    with open(f"{dataset}/process.json", "w+") as f:
+        json.dump(data, f)
 
 
 def get_process(dataset: str) -> Dict[str, Any]:
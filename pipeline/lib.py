@@ -1,20 +1,179 @@
-from multiprocessing.pool import ThreadPool
-from typing import Callable, List
+import atexit
+import os
+import threading
+from multiprocessing.pool import Pool, ThreadPool
+from typing import Callable, Dict, List, Optional
 
-# Process count for multiprocessing
-POOL_SIZE = 4
+from . import profiling
 
 
-def process_map(f: Callable, args: List, packed: bool = False) -> List:
+def _available_cores() -> int:
     """
-    Maps an operation from conversions.py across multiple processes.
-    :param f: The function to map, from conversions.py.
+    Counts the cores available to this process.
+    :return: The number of available cores.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on all platforms
+        return os.cpu_count() or 1
+
+
+# Worker count for multiprocessing
+POOL_SIZE = int(os.environ.get("PIPELINE_POOL_SIZE", 0)) or _available_cores()
+
+# Available execution backends
+BACKENDS = ("serial", "thread", "process")
+
+# Default backends for CPU-bound (image processing) and I/O-bound (copying,
+# downloading) work, used when a call site does not choose a backend
+CPU_BACKEND = os.environ.get("PIPELINE_CPU_BACKEND", "process")
+IO_BACKEND = os.environ.get("PIPELINE_IO_BACKEND", "thread")
+
+# Inputs with fewer than this many tasks per worker are mapped serially by the
+# process backend, as sending them to the workers costs more than it saves
+MIN_TASKS_PER_WORKER = 2
+
+# Worker pools of the thread and process backends, created on first use and
+# reused by later maps, and the working directory each pool was started in
+_pools: Dict[str, Pool] = {}
+_pool_cwds: Dict[str, str] = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(backend: str) -> Pool:
+    """
+    Gets the shared worker pool of a backend, creating it if necessary.
+    Process workers keep the working directory they were started in, so the
+    process pool is replaced when the working directory has changed since,
+    as relative paths sent to the workers would resolve elsewhere.
+    :param backend: "thread" or "process".
+    :return: The pool, with POOL_SIZE workers.
+    """
+    cwd = os.getcwd()
+    stale = None
+    with _pools_lock:
+        pool = _pools.get(backend)
+        if pool is not None and backend == "process" \
+                and _pool_cwds.get(backend) != cwd:
+            stale, pool = pool, None
+        if pool is None:
+            pool_type = ThreadPool if backend == "thread" else Pool
+            pool = _pools[backend] = pool_type(POOL_SIZE)
+            _pool_cwds[backend] = cwd
+    if stale is not None:
+        stale.terminate()
+        stale.join()
+    return pool
+
+
+def shutdown() -> None:
+    """
+    Closes the shared worker pools. They are recreated by the next map, so
+    this can be used to make new process workers pick up changed module
+    state, or to release the workers of an idle program.
+    :return: None.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+        _pool_cwds.clear()
+    for pool in pools:
+        pool.terminate()
+        pool.join()
+
+
+atexit.register(shutdown)
+
+
+def configure(cpu_backend: Optional[str] = None,
+              io_backend: Optional[str] = None,
+              pool_size: Optional[int] = None) -> None:
+    """
+    Sets the default execution backends and worker count.
+    :param cpu_backend: The backend to use for CPU-bound work.
+    :param io_backend: The backend to use for I/O-bound work.
+    :param pool_size: The number of workers to use.
+    :return: None.
+    """
+    global CPU_BACKEND, IO_BACKEND, POOL_SIZE
+    for backend in (cpu_backend, io_backend):
+        if backend is not None and backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}")
+    CPU_BACKEND = cpu_backend or CPU_BACKEND
+    IO_BACKEND = io_backend or IO_BACKEND
+    if pool_size and pool_size != POOL_SIZE:
+        POOL_SIZE = pool_size
+        shutdown()
+
+
+def _is_serial(backend: str, n: int) -> bool:
+    """
+    Decides whether a map runs in the calling thread.
+    :param backend: One of BACKENDS.
+    :param n: The number of tasks.
+    :return: Whether to run the tasks serially.
+    """
+    if backend == "serial" or POOL_SIZE == 1 or n <= 1:
+        return True
+    return backend == "process" and n < POOL_SIZE * MIN_TASKS_PER_WORKER
+
+
+def process_map(f: Callable, args: List, packed: bool = False,
+                backend: Optional[str] = None, io_bound: bool = False,
+                chunksize: Optional[int] = None) -> List:
+    """
+    Maps an operation from conversions.py across multiple processes. The
+    thread and process backends run on shared pools which are kept between
+    calls; process workers are started on first use, so module state changed
+    after that is only seen by them after `shutdown`. Small inputs are mapped
+    serially by the process backend (see MIN_TASKS_PER_WORKER).
+    :param f: The function to map, from conversions.py. Must be defined at
+    module level to be used with the process backend.
     :param args: The list of argument tuples to map over.
     :param packed: Whether the args list consists of packed argument tuples.
+    :param backend: One of BACKENDS, overriding the configured default.
+    :param io_bound: Whether to default to IO_BACKEND instead of CPU_BACKEND.
+    :param chunksize: The number of arguments submitted to a worker at once.
     :return: The list of outputs from the mapping of f over args.
     """
-    with ThreadPool(POOL_SIZE) as p:
+    backend = backend or (IO_BACKEND if io_bound else CPU_BACKEND)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}")
+    if profiling.is_enabled():
+        return _traced_map(f, args, packed, backend, chunksize)
+    if _is_serial(backend, len(args)):
         if packed:
-            return p.starmap(f, args)
+            return [f(*a) for a in args]
+        else:
+            return [f(a) for a in args]
+    p = _get_pool(backend)
+    if packed:
+        return p.starmap(f, args, chunksize)
+    else:
+        return p.map(f, args, chunksize)
+
+
+def _traced_map(f: Callable, args: List, packed: bool, backend: str,
+                chunksize: Optional[int]) -> List:
+    """
+    Maps an operation as in `process_map`, timing the whole map and each task,
+    and merging spans recorded in worker processes.
+    :param f: The function to map.
+    :param args: The list of argument tuples to map over.
+    :param packed: Whether the args list consists of packed argument tuples.
+    :param backend: One of BACKENDS.
+    :param chunksize: The number of arguments submitted to a worker at once.
+    :return: The list of outputs from the mapping of f over args.
+    """
+    task = profiling.TracedTask(f, packed)
+    profiling.count(f"tasks:{getattr(f, '__name__', 'task')}", len(args))
+    with profiling.span(f"map:{getattr(f, '__name__', 'task')}"):
+        if _is_serial(backend, len(args)):
+            outputs = [task(a) for a in args]
         else:
-            return p.map(f, args)
+            outputs = _get_pool(backend).map(task, args, chunksize)
+    results = []
+    for result, recorded in outputs:
+        profiling.merge(recorded)
+        results.append(result)
+    return results
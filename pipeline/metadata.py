@@ -0,0 +1,359 @@
+"""
+An SQLite database of metadata about the images in a data store, `store.db`,
+replacing the original `log.csv` metadata CSV. Each image is a row of the
+`images` table, with the columns:
+    Index       int     the ID of the image
+    File        str     the path to the file (indexed, unique)
+    Class       str     the class label of the image (indexed)
+    Hash        str     the content hash of the image as imported (unique)
+    <flags>     bool    one column per conversion in CONVERSIONS, indicating
+                        whether the conversion has been applied
+
+    Claim       str     the token of a conversion job working on the image
+    Claimed     float   the time the claim was made
+
+Columns for conversions added to CONVERSIONS after the database was created
+are added automatically, and rows recorded without a content hash are hashed
+from their files. Updates are made in transactions covering only the
+affected rows.
+
+The database is safe to use from several processes at once. It runs in WAL
+mode, so readers do not block the single writer, and every write takes the
+database lock up front (`BEGIN IMMEDIATE`), waiting up to TIMEOUT seconds for
+other writers. Conversion jobs claim the rows they work on, so concurrent jobs
+never convert the same image.
+"""
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, \
+    Optional, Set, Tuple
+
+from .context import DataStore, get_store
+from .conversions import CONVERSIONS
+from .profiling import traced
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Maximum number of parameters bound in a single query
+_BATCH = 500
+
+# Seconds to wait for a lock held by another process
+TIMEOUT = 60.0
+
+# Seconds after which a conversion claim is considered abandoned
+CLAIM_TIMEOUT = 3600.0
+
+# Databases whose schema has been checked by this process
+_initialized: Set[str] = set()
+
+
+def _quote(column: str) -> str:
+    """
+    Quotes a column name for use in SQL.
+    :param column: The column name.
+    :return: The quoted column name.
+    """
+    return '"' + column.replace('"', '""') + '"'
+
+
+def _create_schema(conn: sqlite3.Connection) -> None:
+    """
+    Creates the images table and its indexes if they do not exist, and adds
+    any missing conversion flag columns.
+    :param conn: The database connection.
+    :return: None.
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS images ('
+                 '"Index" INTEGER PRIMARY KEY, '
+                 '"File" TEXT NOT NULL UNIQUE, '
+                 '"Class" TEXT NOT NULL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS images_class ON images ("Class")')
+    existing = {r[1] for r in conn.execute("PRAGMA table_info(images)")}
+    for c in CONVERSIONS:
+        if c not in existing:
+            conn.execute(f"ALTER TABLE images ADD COLUMN {_quote(c)} "
+                         f"INTEGER NOT NULL DEFAULT 0")
+    if "Claim" not in existing:
+        conn.execute('ALTER TABLE images ADD COLUMN "Claim" TEXT')
+        conn.execute('ALTER TABLE images ADD COLUMN "Claimed" REAL')
+    if "Hash" not in existing:
+        conn.execute('ALTER TABLE images ADD COLUMN "Hash" TEXT')
+        conn.execute('CREATE UNIQUE INDEX images_hash ON images ("Hash")')
+
+
+def _migrate_csv(conn: sqlite3.Connection, log_path: str) -> None:
+    """
+    Copies the rows of the metadata CSV into the database and renames the CSV
+    so that it is not migrated again.
+    :param conn: The database connection.
+    :param log_path: The path to the metadata CSV.
+    :return: None.
+    """
+    import pandas as pd
+    df = pd.read_csv(log_path, index_col="Index")
+    flags = [c for c in CONVERSIONS if c in df.columns]
+    columns = ", ".join(_quote(c) for c in ["Index", "File", "Class", *flags])
+    values = ", ".join("?" for _ in range(3 + len(flags)))
+    conn.executemany(
+        f"INSERT OR IGNORE INTO images ({columns}) VALUES ({values})",
+        [(int(i), r["File"], r["Class"], *[int(bool(r[c])) for c in flags])
+         for i, r in df.iterrows()])
+    os.replace(log_path, f"{log_path}.migrated")
+
+
+def _file_hash(fp: str) -> str:
+    """
+    Hashes the content of a file as it is hashed when imported.
+    :param fp: The path to the file.
+    :return: The hex digest of the content.
+    """
+    digest = hashlib.sha256()
+    with open(fp, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _backfill_hashes(conn: sqlite3.Connection) -> None:
+    """
+    Records the content hash of rows added before hashes were recorded, or
+    migrated from the metadata CSV, by hashing their files, so that
+    re-importing the same images is detected. Rows whose file is missing are
+    left without a hash, as are rows whose content duplicates another row.
+    Images converted in place before conversions wrote new files are hashed
+    as converted, and so only match imports of the converted image.
+    :param conn: The database connection.
+    :return: None.
+    """
+    rows = conn.execute(
+        'SELECT "Index", "File" FROM images WHERE "Hash" IS NULL').fetchall()
+    updates = []
+    for i, fp in rows:
+        try:
+            updates.append((_file_hash(fp), i))
+        except FileNotFoundError:
+            pass
+    conn.executemany('UPDATE OR IGNORE images SET "Hash" = ? '
+                     'WHERE "Index" = ?', updates)
+
+
+@contextmanager
+def _begin(conn: sqlite3.Connection, mode: str = "IMMEDIATE") \
+        -> Iterator[sqlite3.Connection]:
+    """
+    Runs a block in a transaction, committing on success and rolling back on
+    failure.
+    :param conn: The database connection, in autocommit mode.
+    :param mode: The SQLite transaction mode. IMMEDIATE takes the write lock
+    when the transaction begins, DEFERRED on the first write.
+    :return: The connection.
+    """
+    conn.execute(f"BEGIN {mode}")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def connect(store: Optional[DataStore] = None) -> sqlite3.Connection:
+    """
+    Opens the metadata database in autocommit mode, creating it and migrating
+    the metadata CSV if necessary.
+    :param store: The data store, or the default store.
+    :return: The database connection.
+    """
+    store = get_store(store)
+    initialized = os.path.abspath(store.db) in _initialized
+    if not initialized:
+        os.makedirs(store.root, exist_ok=True)
+    conn = sqlite3.connect(store.db, timeout=TIMEOUT, isolation_level=None)
+    if not initialized:
+        conn.execute("PRAGMA journal_mode=WAL")
+        with _begin(conn):
+            _create_schema(conn)
+            if os.path.exists(store.log):
+                _migrate_csv(conn, store.log)
+            _backfill_hashes(conn)
+        _initialized.add(os.path.abspath(store.db))
+    return conn
+
+
+@contextmanager
+def transaction(mode: str = "IMMEDIATE", store: Optional[DataStore] = None) \
+        -> Iterator[sqlite3.Connection]:
+    """
+    Opens the metadata database and runs a block in a single transaction.
+    :param mode: The SQLite transaction mode.
+    :param store: The data store, or the default store.
+    :return: The connection.
+    """
+    with closing(connect(store)) as conn, _begin(conn, mode):
+        yield conn
+
+
+def init_metadata(store: Optional[DataStore] = None) -> None:
+    """
+    Creates the metadata database if it does not exist.
+    :param store: The data store, or the default store.
+    :return: None.
+    """
+    connect(store).close()
+
+
+def _row_frame(rows: List[Tuple], columns: List[str]) -> "pd.DataFrame":
+    """
+    Converts rows of the images table into a data frame indexed by Index.
+    :param rows: The rows selected.
+    :param columns: The column names of the rows.
+    :return: The data frame, with conversion flags as booleans.
+    """
+    import pandas as pd
+    df = pd.DataFrame(rows, columns=columns).set_index("Index")
+    for c in CONVERSIONS:
+        df[c] = df[c].astype(bool)
+    return df
+
+
+def _select(conn: sqlite3.Connection, columns: List[str],
+            files: Optional[Iterable[str]] = None,
+            classes: Optional[Iterable[str]] = None) -> List[Tuple]:
+    """
+    Selects rows by file or class, using the table indexes.
+    :param conn: The database connection.
+    :param columns: The columns to select, starting with Index, File and Class.
+    :param files: The files to select, or all files.
+    :param classes: The classes to select, or all classes.
+    :return: The selected rows, ordered by Index.
+    """
+    select = f"SELECT {', '.join(_quote(c) for c in columns)} FROM images"
+    if files is None and classes is None:
+        return conn.execute(f'{select} ORDER BY "Index"').fetchall()
+    column, keys = ("File", files) if files is not None else ("Class", classes)
+    keys = list(dict.fromkeys(keys))
+    rows = []
+    for i in range(0, len(keys), _BATCH):
+        batch = keys[i:i + _BATCH]
+        rows += conn.execute(
+            f"{select} WHERE {_quote(column)} IN "
+            f"({', '.join('?' for _ in batch)})", batch).fetchall()
+    if files is not None and classes is not None:
+        classes = set(classes)
+        rows = [r for r in rows if r[2] in classes]
+    rows.sort(key=lambda r: r[0])
+    return rows
+
+
+@traced("metadata:select")
+def select_images(files: Optional[Iterable[str]] = None,
+                  classes: Optional[Iterable[str]] = None,
+                  store: Optional[DataStore] = None) -> "pd.DataFrame":
+    """
+    Selects metadata rows by file or class, using the table indexes.
+    :param files: The files to select, or all files.
+    :param classes: The classes to select, or all classes.
+    :param store: The data store, or the default store.
+    :return: A data frame of the selected rows, ordered by Index.
+    """
+    columns = ["Index", "File", "Class", *CONVERSIONS]
+    with transaction("DEFERRED", store) as conn:
+        rows = _select(conn, columns, files, classes)
+    return _row_frame(rows, columns)
+
+
+@traced("metadata:insert")
+def insert_images(images: List[Tuple[str, str, str]],
+                  store: Optional[DataStore] = None) -> None:
+    """
+    Adds images to the metadata in a single transaction, with no conversions
+    applied. Images whose file or content hash is already present are skipped.
+    :param images: The file, class label and content hash of each image.
+    :param store: The data store, or the default store.
+    :return: None.
+    """
+    with transaction(store=store) as conn:
+        conn.executemany('INSERT OR IGNORE INTO images ("File", "Class", '
+                         '"Hash") VALUES (?, ?, ?)', images)
+
+
+@traced("metadata:claim")
+def claim_conversions(files: Iterable[str], conversions: List[str],
+                      token: str, store: Optional[DataStore] = None) \
+        -> List[Tuple[str, List[str]]]:
+    """
+    Claims images for a conversion job. Images claimed by another job within
+    the last CLAIM_TIMEOUT seconds, and images needing none of the
+    conversions, are skipped.
+    :param files: The files to convert.
+    :param conversions: The conversions to apply.
+    :param token: A token identifying the conversion job.
+    :param store: The data store, or the default store.
+    :return: Each claimed file with the conversions it still needs.
+    """
+    now = time.time()
+    with transaction(store=store) as conn:
+        rows = _select(conn, ["Index", "File", "Class", "Claim", "Claimed",
+                              *conversions], files)
+        claimed = [
+            (r[1], [c for c, done in zip(conversions, r[5:]) if not done])
+            for r in rows if r[3] is None or now - r[4] > CLAIM_TIMEOUT
+        ]
+        claimed = [(f, c) for f, c in claimed if c]
+        conn.executemany(
+            'UPDATE images SET "Claim" = ?, "Claimed" = ? WHERE "File" = ?',
+            [(token, now, f) for f, _ in claimed])
+    return claimed
+
+
+@traced("metadata:release")
+def release_claims(files: Iterable[str], token: str,
+                   store: Optional[DataStore] = None) -> None:
+    """
+    Releases the claims of a conversion job without recording conversions.
+    :param files: The claimed files.
+    :param token: The token of the conversion job.
+    :param store: The data store, or the default store.
+    :return: None.
+    """
+    with transaction(store=store) as conn:
+        conn.executemany(
+            'UPDATE images SET "Claim" = NULL, "Claimed" = NULL '
+            'WHERE "File" = ? AND "Claim" = ?', [(f, token) for f in files])
+
+
+@traced("metadata:update")
+def update_conversions(updates: List[Tuple[str, str, List[str]]],
+                       store: Optional[DataStore] = None) -> None:
+    """
+    Records converted images in a single transaction, releasing any claims on
+    them.
+    :param updates: The old path, new path and conversions applied for each
+    converted image.
+    :param store: The data store, or the default store.
+    :return: None.
+    """
+    groups: Dict[Tuple[str, ...], List[Tuple[str, str]]] = {}
+    for old, new, conversions in updates:
+        groups.setdefault(tuple(conversions), []).append((new, old))
+    with transaction(store=store) as conn:
+        for conversions, rows in groups.items():
+            flags = "".join(f", {_quote(c)} = 1" for c in conversions)
+            conn.executemany(
+                f'UPDATE images SET "File" = ?{flags}, "Claim" = NULL, '
+                f'"Claimed" = NULL WHERE "File" = ?', rows)
+
+
+@traced("metadata:export")
+def export_csv(path: str, store: Optional[DataStore] = None) -> None:
+    """
+    Writes the metadata to a CSV in the format of the original metadata CSV.
+    :param path: The path to write to.
+    :param store: The data store, or the default store.
+    :return: None.
+    """
+    select_images(store=store).to_csv(path, index_label="Index")
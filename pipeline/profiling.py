@@ -0,0 +1,237 @@
+"""
+Lightweight timing instrumentation for the pipeline.
+
+Stages of the pipeline are wrapped in named spans, and events can be tallied
+with counters. Instrumentation is off by default, in which case `span` returns
+a shared no-op context manager and `count` returns immediately. Enable it with
+`enable()` or by setting the environment variable PIPELINE_PROFILE=1.
+
+Recorded spans can be summarised per stage with `summary` and written with
+`dump_trace` as a Chrome trace event file, which can be loaded into trace
+viewers such as chrome://tracing or Perfetto. Spans recorded in worker
+processes of `process_map` are sent back and merged with those of the parent.
+"""
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Maximum number of spans kept for the trace file; the summary is unaffected
+MAX_EVENTS = 1000000
+
+_enabled = os.environ.get("PIPELINE_PROFILE") == "1"
+_lock = threading.Lock()
+_events: List[Dict[str, Any]] = []
+_stats: Dict[str, List[float]] = {}
+_counters: Dict[str, float] = {}
+_null = contextlib.nullcontext()
+
+
+def enable() -> None:
+    """
+    Turns instrumentation on.
+    :return: None.
+    """
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    """
+    Turns instrumentation off, keeping what has been recorded.
+    :return: None.
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    """
+    :return: Whether instrumentation is on.
+    """
+    return _enabled
+
+
+def reset() -> None:
+    """
+    Discards all recorded spans and counters.
+    :return: None.
+    """
+    with _lock:
+        _events.clear()
+        _stats.clear()
+        _counters.clear()
+
+
+def _record(event: Dict[str, Any]) -> None:
+    """
+    Records a completed span.
+    :param event: The span as a Chrome trace event.
+    :return: None.
+    """
+    with _lock:
+        if len(_events) < MAX_EVENTS:
+            _events.append(event)
+        stats = _stats.setdefault(event["name"], [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += event["dur"]
+        stats[2] = max(stats[2], event["dur"])
+
+
+class _Span:
+    """
+    A context manager timing a block.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter_ns()
+        _record({"name": self.name, "ph": "X", "pid": os.getpid(),
+                 "tid": threading.get_ident(), "ts": self.start / 1000,
+                 "dur": (end - self.start) / 1000})
+
+
+def span(name: str):
+    """
+    Times a block of code as a named stage.
+    :param name: The name of the stage.
+    :return: A context manager timing the block if instrumentation is on.
+    """
+    return _Span(name) if _enabled else _null
+
+
+def count(name: str, n: float = 1) -> None:
+    """
+    Adds to a named counter.
+    :param name: The name of the counter.
+    :param n: The amount to add.
+    :return: None.
+    """
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def traced(name: str) -> Callable[[Callable], Callable]:
+    """
+    Decorates a function to be timed as a named stage.
+    :param name: The name of the stage.
+    :return: The decorator.
+    """
+    def _decorator(f: Callable) -> Callable:
+        @functools.wraps(f)
+        def _wrapper(*args, **kwargs):
+            if not _enabled:
+                return f(*args, **kwargs)
+            with _Span(name):
+                return f(*args, **kwargs)
+        return _wrapper
+    return _decorator
+
+
+class TracedTask:
+    """
+    Wraps a function mapped by `process_map` so that each call is timed as a
+    task span. In a worker process, the spans and counters recorded during the
+    call are returned alongside its result, to be merged into the parent with
+    `merge`.
+    """
+
+    def __init__(self, f: Callable, packed: bool):
+        self.f = f
+        self.packed = packed
+        self.name = f"task:{getattr(f, '__name__', 'task')}"
+        self.parent = os.getpid()
+
+    def __call__(self, args) -> Tuple[Any, Optional[Dict[str, Any]]]:
+        if os.getpid() == self.parent:
+            with span(self.name):
+                return (self.f(*args) if self.packed else self.f(args)), None
+        # Pool workers are reused by untraced maps, so they are returned to
+        # their previous state rather than left recording
+        previous = _enabled
+        enable()
+        reset()
+        try:
+            with _Span(self.name):
+                result = self.f(*args) if self.packed else self.f(args)
+            with _lock:
+                recorded = {"events": list(_events),
+                            "counters": dict(_counters)}
+        finally:
+            reset()
+            if not previous:
+                disable()
+        return result, recorded
+
+
+def merge(recorded: Optional[Dict[str, Any]]) -> None:
+    """
+    Merges spans and counters recorded in a worker process.
+    :param recorded: The spans and counters returned by a `TracedTask`.
+    :return: None.
+    """
+    if recorded is None:
+        return
+    for event in recorded["events"]:
+        _record(event)
+    for name, n in recorded["counters"].items():
+        count(name, n)
+
+
+def summary() -> Dict[str, Dict[str, float]]:
+    """
+    Summarises the recorded spans and counters per stage.
+    :return: An object mapping each stage to its call count and total, mean
+    and maximum time in milliseconds, plus the counters under "counters".
+    """
+    with _lock:
+        result: Dict[str, Any] = {
+            name: {"calls": n, "total_ms": total / 1000,
+                   "mean_ms": total / n / 1000, "max_ms": longest / 1000}
+            for name, (n, total, longest) in _stats.items()
+        }
+        result["counters"] = dict(_counters)
+    return result
+
+
+def print_summary() -> None:
+    """
+    Prints the per-stage summary, slowest stages first.
+    :return: None.
+    """
+    stats = summary()
+    counters = stats.pop("counters")
+    print(f"{'stage':<40} {'calls':>8} {'total ms':>12} {'mean ms':>10} "
+          f"{'max ms':>10}")
+    for name, s in sorted(stats.items(), key=lambda x: -x[1]["total_ms"]):
+        print(f"{name:<40} {s['calls']:>8} {s['total_ms']:12.1f} "
+              f"{s['mean_ms']:10.3f} {s['max_ms']:10.3f}")
+    for name, n in sorted(counters.items()):
+        print(f"{name:<40} {n:>8}")
+
+
+def dump_trace(path: str) -> None:
+    """
+    Writes the recorded spans as a Chrome trace event file.
+    :param path: The path to write to.
+    :return: None.
+    """
+    with _lock:
+        events = list(_events)
+        counters = dict(_counters)
+    if events:
+        end = max(e["ts"] + e["dur"] for e in events)
+        events += [{"name": name, "ph": "C", "pid": os.getpid(), "ts": end,
+                    "args": {name: n}} for name, n in counters.items()]
+    with open(path, "w+") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -1,17 +1,38 @@
 """
 Functions for retrieving images.
 """
-import imghdr
+import hashlib
+import itertools
 import os
-import random
-import shutil
+import threading
 import time
-from typing import Optional
+import uuid
+from multiprocessing.pool import ThreadPool
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
 
-import requests
+from .context import DataStore, get_store
+from .profiling import traced
+
+if TYPE_CHECKING:
+    import requests
 
 IMAGE_FORMATS = ["jpg", "jpeg", "png", "gif", "tiff", "tif", "bmp"]
 
+# Bulk download settings
+DOWNLOAD_WORKERS = 32
+DOWNLOADS_PER_HOST = 8
+DOWNLOAD_TIMEOUT = (5.0, 30.0)
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Read size when copying local images
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# HTTP statuses worth retrying
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
 
 def _get_filetype_from_name(name: str) -> Optional[str]:
     """
@@ -28,53 +49,295 @@ def _get_filetype_from_name(name: str) -> Optional[str]:
 
 def _check_filetype(fp: str, extension: str) -> bool:
     """
-    Checks whether a file is an image file encoding.
+    Checks whether a file is an image file encoding, reading only its header.
     :param fp: The file to check.
     :return: True if the file is an image
     """
-    extension = "jpeg" if extension == "jpg" else extension
-    return imghdr.what(fp) == extension
+    with open(fp, "rb") as f:
+        head = f.read(16)
+    return _sniff_filetype(head) == _normalize_extension(extension)
 
 
-def _generate_file_name() -> str:
+def _write_to_store(chunks: Iterable[bytes], extension: str,
+                    store: DataStore) -> str:
     """
-    Generates a "unique" filename/ID for an image.
-    :return: The image name.
+    Writes an image to the data folder under the hash of its content, so that
+    importing the same image twice results in a single file. The image is
+    written to a temporary file first and renamed into place once complete.
+    :param chunks: The content of the image.
+    :param extension: The extension of the image.
+    :param store: The data store.
+    :return: A path to the image in the data folder.
     """
-    return f"{int(time.time())}{random.randint(100000000, 999999999)}"
+    digest = hashlib.sha256()
+    tmp = f"{store.images}/{uuid.uuid4().hex}.part"
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+        new_path = f"{store.images}/{digest.hexdigest()}.{extension}"
+        if os.path.exists(new_path):
+            os.remove(tmp)
+        else:
+            os.replace(tmp, new_path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    return new_path
 
 
-def copy_to_store(fp: str) -> Optional[str]:
+def content_hash_of(fp: str) -> str:
+    """
+    Gets the content hash of an image in the data folder from its name.
+    :param fp: The path to the image.
+    :return: The hex digest of the content the image was imported with.
     """
-    Copies an image to data folder.
+    return os.path.basename(fp).split('.')[0]
+
+
+@traced("copy")
+def copy_to_store(fp: str, store: Optional[DataStore] = None) \
+        -> Optional[str]:
+    """
+    Copies an image to data folder, named by the hash of its content.
     :param fp: The image to copy.
-    :return: A path to the new image.
+    :param store: The data store, or the default store.
+    :return: A path to the new image, which may already have existed.
     """
     name = os.path.basename(fp)
     extension = _get_filetype_from_name(name)
     if extension and _check_filetype(fp, extension):
-        new_path = f"data/images/{_generate_file_name()}.{extension}"
-        shutil.copyfile(fp, new_path)
-        return new_path
+        with open(fp, "rb") as f:
+            return _write_to_store(iter(lambda: f.read(COPY_CHUNK_SIZE), b""),
+                                   extension, get_store(store))
     else:
         return None
 
 
-def download_to_store(url: str) -> Optional[str]:
+def _sniff_filetype(head: bytes) -> Optional[str]:
+    """
+    Detects an image encoding from the first bytes of a file.
+    :param head: At least the first 16 bytes of the file.
+    :return: The image extension, if the bytes are a known image header.
+    """
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    if head.startswith(b"BM"):
+        return "bmp"
+    return None
+
+
+def _normalize_extension(extension: str) -> str:
+    """
+    Maps equivalent image extensions to a single name.
+    :param extension: The extension.
+    :return: The normalized extension.
+    """
+    return {"jpg": "jpeg", "tif": "tiff"}.get(extension, extension)
+
+
+_stats_lock = threading.Lock()
+_latest_stats: Dict[str, float] = {}
+
+
+def _make_session(pool_size: int) -> "requests.Session":
+    """
+    Creates an HTTP session reusing up to `pool_size` connections per host.
+    :param pool_size: The connection pool size.
+    :return: The session.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@traced("download")
+def _stream_to_store(session: "requests.Session", url: str,
+                     extension: Optional[str], timeout: Tuple[float, float],
+                     store: DataStore) -> Optional[str]:
+    """
+    Streams an image to the data folder, validating its encoding from the
+    first bytes received.
+    :param session: The HTTP session to use.
+    :param url: The URL of the image.
+    :param extension: The extension given by the URL, if any.
+    :param timeout: The connect and read timeouts in seconds.
+    :param store: The data store.
+    :return: A path to the new image, named by the hash of its content, or
+    None if it is not a valid image.
+    """
+    with session.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        chunks = response.iter_content(DOWNLOAD_CHUNK_SIZE)
+        head = b""
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= 16:
+                break
+        sniffed = _sniff_filetype(head)
+        if sniffed is None or (extension and
+                               _normalize_extension(extension) != sniffed):
+            return None
+        return _write_to_store(itertools.chain([head], chunks),
+                               extension or sniffed, store)
+
+
+class _BulkDownload:
+    """
+    The state of one call to `bulk_download_to_store`: its session, settings,
+    per-host limits and counters, shared by its download threads only.
+    """
+
+    def __init__(self, session: "requests.Session", per_host: int,
+                 timeout: Tuple[float, float], retries: int, backoff: float,
+                 store: DataStore):
+        self.session = session
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.store = store
+        self.stats: Dict[str, float] = {
+            "downloaded": 0, "rejected": 0, "failed": 0, "retries": 0,
+            "bytes": 0, "seconds": 0.0, "images_per_second": 0.0
+        }
+        self._lock = threading.Lock()
+        self._host_limits: Dict[str, threading.Semaphore] = {}
+
+    def _count(self, key: str, n: float = 1) -> None:
+        """
+        Adds to a counter.
+        :param key: The counter.
+        :param n: The amount to add.
+        :return: None.
+        """
+        with self._lock:
+            self.stats[key] += n
+
+    def _host_limit(self, url: str) -> threading.Semaphore:
+        """
+        Gets the semaphore limiting concurrent downloads from the host of a
+        URL.
+        :param url: The URL.
+        :return: The semaphore of the host.
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.Semaphore(self.per_host)
+            return self._host_limits[host]
+
+    def download(self, url: str) -> Optional[str]:
+        """
+        Downloads an image, retrying transient failures with exponential
+        backoff.
+        :param url: The URL of the image.
+        :return: A path to the new image, or None if it could not be
+        downloaded.
+        """
+        import requests
+
+        name = url.split('/')[-1].split('?')[0].lower()
+        extension = _get_filetype_from_name(name)
+        for attempt in range(self.retries + 1):
+            try:
+                with self._host_limit(url):
+                    path = _stream_to_store(self.session, url, extension,
+                                            self.timeout, self.store)
+                if path:
+                    self._count("downloaded")
+                    self._count("bytes", os.path.getsize(path))
+                else:
+                    self._count("rejected")
+                return path
+            except requests.RequestException as e:
+                status = e.response.status_code \
+                    if e.response is not None else None
+                if attempt == self.retries or (
+                        status is not None and status not in RETRY_STATUSES):
+                    break
+                self._count("retries")
+                time.sleep(self.backoff * 2 ** attempt)
+        self._count("failed")
+        return None
+
+
+def download_stats() -> Dict[str, float]:
+    """
+    Returns the download counters of the most recently finished bulk download
+    of this process. Concurrent callers should pass `stats` to
+    `bulk_download_to_store` instead.
+    :return: An object of image and byte counts and throughput.
+    """
+    with _stats_lock:
+        return dict(_latest_stats)
+
+
+def bulk_download_to_store(urls: List[str], workers: int = DOWNLOAD_WORKERS,
+                           per_host: int = DOWNLOADS_PER_HOST,
+                           timeout: Tuple[float, float] = DOWNLOAD_TIMEOUT,
+                           retries: int = DOWNLOAD_RETRIES,
+                           backoff: float = DOWNLOAD_BACKOFF,
+                           store: Optional[DataStore] = None,
+                           stats: Optional[Dict[str, float]] = None) \
+        -> List[Optional[str]]:
+    """
+    Downloads images from URLs to the data folder concurrently, over pooled
+    connections, streaming each image to disk. Images whose first bytes are
+    not an image header matching the URL extension are rejected without being
+    downloaded in full.
+    :param urls: The URLs of the images to download.
+    :param workers: The maximum number of concurrent downloads.
+    :param per_host: The maximum number of concurrent downloads per host.
+    :param timeout: The connect and read timeouts in seconds.
+    :param retries: The number of retries after a transient failure.
+    :param backoff: The delay before the first retry in seconds, doubled for
+    each further retry.
+    :param store: The data store, or the default store.
+    :param stats: An object to fill with the download counters of this call,
+    as returned by `download_stats`.
+    :return: A path to each new image, or None for images which could not be
+    downloaded.
+    """
+    start = time.perf_counter()
+    with _make_session(workers) as session, \
+            ThreadPool(max(1, min(workers, len(urls)))) as pool:
+        bulk = _BulkDownload(session, per_host, timeout, retries, backoff,
+                             get_store(store))
+        paths = pool.map(bulk.download, urls)
+    elapsed = time.perf_counter() - start
+    bulk.stats["seconds"] = elapsed
+    bulk.stats["images_per_second"] = \
+        bulk.stats["downloaded"] / elapsed if elapsed else 0.0
+    with _stats_lock:
+        _latest_stats.clear()
+        _latest_stats.update(bulk.stats)
+    if stats is not None:
+        stats.update(bulk.stats)
+    return paths
+
+
+def download_to_store(url: str, store: Optional[DataStore] = None) \
+        -> Optional[str]:
     """
     Downloads an image from a URL to data folder.
     :param url: The URL of the image to download.
+    :param store: The data store, or the default store.
     :return: A path to the new image.
     """
-    name = url.split('/')[-1].lower()
-    extension = _get_filetype_from_name(name)
-    if extension:
-        response = requests.get(url)
-        new_path = f"data/images/{_generate_file_name()}.{extension}"
-        with open(new_path, "wb") as f:
-            f.write(response.content)
-        if _check_filetype(new_path, extension):
-            return new_path
-        else:
-            os.remove(new_path)
-            return None
+    return bulk_download_to_store([url], store=store)[0]
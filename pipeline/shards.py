@@ -0,0 +1,170 @@
+"""
+A packed format for dataset images, storing decoded images in a few large
+files instead of one file per image.
+
+A packed dataset has a `shards` directory containing numpy files
+`shard-00000.npy`, `shard-00001.npy`, ..., each holding up to SHARD_SIZE
+decoded images stacked into a single array, and an `index.json` file listing
+the shards with the offset of their first image, along with the shape and type
+of the images and their class labels. All images of a packed dataset must have
+the same shape and type, so packed datasets should include the "Size Scaled"
+conversion.
+
+Shards are memory-mapped when read, giving random access to any image by index
+and sequential streaming of the whole dataset as a handful of large reads.
+"""
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# Maximum number of images per shard
+SHARD_SIZE = 4096
+
+
+def is_packed(dataset: str) -> bool:
+    """
+    Checks whether a dataset stores its images in the packed format.
+    :param dataset: The path to the dataset.
+    :return: Whether the dataset is packed.
+    """
+    return os.path.exists(f"{dataset}/shards/index.json")
+
+
+class ShardWriter:
+    """
+    Writes images to the shards of a dataset in order. The index is written by
+    `close`, so a dataset is only readable once all its images are written.
+    """
+
+    def __init__(self, dataset: str, count: int):
+        """
+        :param dataset: The path to the dataset.
+        :param count: The total number of images to be written.
+        """
+        self.directory = f"{dataset}/shards"
+        self.count = count
+        self.written = 0
+        self.shards: List[Dict[str, Any]] = []
+        self.labels: List[str] = []
+        self._shard: Optional[np.ndarray] = None
+        self._shape = None
+        self._dtype = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _next_shard(self) -> None:
+        """
+        Finishes the current shard and starts a new one.
+        :return: None.
+        """
+        if self._shard is not None:
+            self._shard.flush()
+        name = f"shard-{len(self.shards):05d}.npy"
+        size = min(SHARD_SIZE, self.count - self.written)
+        self._shard = open_memmap(f"{self.directory}/{name}", mode="w+",
+                                  dtype=self._dtype,
+                                  shape=(size, *self._shape))
+        self.shards.append({"File": name, "Start": self.written,
+                            "Count": size})
+
+    def write(self, arr: np.ndarray, label: str) -> None:
+        """
+        Writes the next image.
+        :param arr: The image data.
+        :param label: The class label of the image.
+        :return: None.
+        """
+        if self._shape is None:
+            self._shape, self._dtype = arr.shape, arr.dtype
+        elif arr.shape != self._shape or arr.dtype != self._dtype:
+            raise ValueError(f"Image of shape {arr.shape} and type "
+                             f"{arr.dtype} does not match the shape "
+                             f"{self._shape} and type {self._dtype} of the "
+                             f"dataset")
+        if self._shard is None or \
+                self.written == self.shards[-1]["Start"] + len(self._shard):
+            self._next_shard()
+        self._shard[self.written - self.shards[-1]["Start"]] = arr
+        self.labels.append(label)
+        self.written += 1
+
+    def close(self) -> None:
+        """
+        Flushes the shards and writes the index.
+        :return: None.
+        """
+        if self._shard is not None:
+            self._shard.flush()
+            self._shard = None
+        index = {
+            "Shape": list(self._shape or []),
+            "Dtype": str(self._dtype or "uint8"),
+            "Count": self.written,
+            "Shards": self.shards,
+            "Labels": self.labels
+        }
+        with open(f"{self.directory}/index.json", "w+") as f:
+            json.dump(index, f)
+
+
+class ShardReader:
+    """
+    Reads the images of a packed dataset, by index or as a stream of chunks.
+    """
+
+    def __init__(self, dataset: str):
+        """
+        :param dataset: The path to the dataset.
+        """
+        self.directory = f"{dataset}/shards"
+        with open(f"{self.directory}/index.json", "r") as f:
+            index = json.load(f)
+        self.shape = tuple(index["Shape"])
+        self.dtype = np.dtype(index["Dtype"])
+        self.labels: List[str] = index["Labels"]
+        self.shards = index["Shards"]
+        self._starts = np.array([s["Start"] for s in self.shards])
+        self._arrays: Dict[int, np.ndarray] = {}
+        self._count = index["Count"]
+
+    def _shard(self, i: int) -> np.ndarray:
+        """
+        Memory-maps a shard.
+        :param i: The index of the shard.
+        :return: The images of the shard.
+        """
+        if i not in self._arrays:
+            self._arrays[i] = np.load(
+                f"{self.directory}/{self.shards[i]['File']}", mmap_mode="r")
+        return self._arrays[i]
+
+    def __len__(self) -> int:
+        """
+        :return: The number of images in the dataset.
+        """
+        return self._count
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        """
+        Reads an image by index.
+        :param i: The index of the image.
+        :return: The image data, memory-mapped from its shard.
+        """
+        if not -self._count <= i < self._count:
+            raise IndexError(i)
+        i %= self._count
+        shard = int(np.searchsorted(self._starts, i, side="right")) - 1
+        return self._shard(shard)[i - self.shards[shard]["Start"]]
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[np.ndarray]:
+        """
+        Streams the images in order, reading each shard sequentially.
+        :param chunk_size: The maximum number of images per chunk.
+        :return: An iterator over stacked chunks of images.
+        """
+        for i in range(len(self.shards)):
+            shard = self._shard(i)
+            for start in range(0, len(shard), chunk_size):
+                yield shard[start:start + chunk_size]
@@ -2,13 +2,23 @@
 Functions for manipulating the general data store.
 """
 import os
-from typing import Dict, List, Optional
+import uuid
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
 
-import pandas as pd
+import numpy as np
 
-from .conversions import CONVERSIONS
+from .context import DataStore, get_store
+from .conversions import convert_chain
 from .lib import process_map
-from .retrieval import download_to_store, copy_to_store
+from .metadata import claim_conversions, init_metadata, insert_images, \
+    release_claims, select_images, update_conversions
+from .profiling import traced
+from .retrieval import bulk_download_to_store, content_hash_of, \
+    copy_to_store
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 CLASSES: Dict[str, int] = {
     "Unlabeled": -1,
@@ -33,59 +43,168 @@ CLASSES: Dict[str, int] = {
 
 DEFAULT_CLASS: str = "Unlabeled"
 
+# Class IDs are decoded through a table indexed by ID when their range is at
+# most this many times the number of classes, and by binary search otherwise
+MAX_TABLE_SPARSITY = 4
+
 
-def _init_label_store() -> None:
+class ClassIndex:
     """
-    Creates a CSV to store information about image data. The included columns,
-    listed in logical categories, are:
-        --- Data --------------------------------------------------------------
-        general information about the file
-        File        str     the name of the file
-        Class       int     the class value of the image
-        --- Flags -------------------------------------------------------------
-        Whether the file has been converted or verified to be a certain form.
-        Columns in this section have type bool and are generated from the list
-        of conversions imported from `conversions.py`.
-    :return: None
+    A bidirectional mapping between class names and integer IDs, held as
+    arrays so that whole label columns are encoded and decoded at once.
+    """
+
+    def __init__(self, classes: Dict[str, int]):
+        """
+        :param classes: The ID of each class name. IDs must be unique.
+        """
+        if not classes:
+            raise ValueError("A class set needs at least one class")
+        if len(set(classes.values())) != len(classes):
+            raise ValueError("Class IDs must be unique")
+        self.classes = dict(classes)
+        # Names in sorted order with their IDs, for binary search on encode
+        order = sorted(classes)
+        self._sorted_names = np.array(order, dtype=str)
+        self._sorted_ids = np.array([classes[c] for c in order], dtype=int)
+        # IDs in sorted order with their names, for binary search on decode
+        by_id = sorted(classes, key=classes.get)
+        self._id_order = np.array([classes[c] for c in by_id], dtype=int)
+        self._id_names = np.array(by_id, dtype=object)
+        # Name of each ID offset by the smallest ID, for direct lookup on
+        # decode when the IDs are dense enough
+        self._offset = int(self._id_order[0])
+        span = int(self._id_order[-1]) - self._offset + 1
+        self._names: Optional[np.ndarray] = None
+        if span <= MAX_TABLE_SPARSITY * len(classes):
+            self._names = np.empty(span, dtype=object)
+            self._names[self._id_order - self._offset] = self._id_names
+            self._defined = np.zeros(span, dtype=bool)
+            self._defined[self._id_order - self._offset] = True
+
+    def encode(self, names: Sequence[str]) -> np.ndarray:
+        """
+        Converts class names to IDs.
+        :param names: The class names.
+        :return: The class IDs.
+        """
+        names = np.asarray(names, dtype=str)
+        pos = np.searchsorted(self._sorted_names, names)
+        pos = np.minimum(pos, len(self._sorted_names) - 1)
+        unknown = self._sorted_names[pos] != names
+        if unknown.any():
+            raise KeyError(f"Unknown class {names[unknown][0]}")
+        return self._sorted_ids[pos]
+
+    def decode(self, ids: Sequence[int]) -> np.ndarray:
+        """
+        Converts class IDs to names.
+        :param ids: The class IDs.
+        :return: The class names, as an object array.
+        """
+        ids = np.asarray(ids, dtype=int)
+        if self._names is not None:
+            pos = ids - self._offset
+            valid = (pos >= 0) & (pos < len(self._names))
+            valid[valid] = self._defined[pos[valid]]
+            names = self._names
+        else:
+            pos = np.minimum(np.searchsorted(self._id_order, ids),
+                             len(self._id_order) - 1)
+            valid = self._id_order[pos] == ids
+            names = self._id_names
+        if not valid.all():
+            raise ValueError(f"Unknown class ID {ids[~valid][0]}")
+        return names[pos]
+
+
+@lru_cache(maxsize=16)
+def _class_index(classes: Tuple[Tuple[str, int], ...]) -> ClassIndex:
+    """
+    Builds the class index of a class set, caching it for reuse.
+    :param classes: The name and ID of each class.
+    :return: The class index.
+    """
+    return ClassIndex(dict(classes))
+
+
+def get_class_index(classes: Optional[Dict[str, int]] = None) -> ClassIndex:
+    """
+    Gets the class index of a class set.
+    :param classes: The ID of each class name, defaulting to CLASSES.
+    :return: The class index.
     """
-    df = pd.DataFrame(columns=["File", "Class", *CONVERSIONS.keys()])
-    df.to_csv("data/log.csv", index_label="Index")
+    return _class_index(tuple(sorted((classes or CLASSES).items())))
 
 
-def init_data_store() -> None:
+def encode_labels(names: Sequence[str],
+                  classes: Optional[Dict[str, int]] = None) -> np.ndarray:
     """
-    If no data store exists, create one.
+    Converts class names to IDs.
+    :param names: The class names.
+    :param classes: The ID of each class name, defaulting to CLASSES.
+    :return: The class IDs.
+    """
+    return get_class_index(classes).encode(names)
+
+
+def decode_labels(ids: Sequence[int],
+                  classes: Optional[Dict[str, int]] = None) -> np.ndarray:
+    """
+    Converts class IDs to names.
+    :param ids: The class IDs.
+    :param classes: The ID of each class name, defaulting to CLASSES.
+    :return: The class names, as an object array.
+    """
+    return get_class_index(classes).decode(ids)
+
+
+def init_data_store(store: Optional[DataStore] = None) -> None:
+    """
+    If no data store exists, create one. Called by the functions of this
+    module which add to the store, so calling it explicitly is optional.
+    :param store: The data store, or the default store.
     :return: None
     """
-    try:
-        os.mkdir("data")
-        os.mkdir("data/images")
-        os.mkdir("data/datasets")
-        _init_label_store()
-    except FileExistsError:
-        pass
+    store = get_store(store)
+    os.makedirs(store.images, exist_ok=True)
+    os.makedirs(store.datasets, exist_ok=True)
+    init_metadata(store)
 
 
+@traced("import_images")
 def import_images(images: List[str], labels: Optional[List[str]] = None,
-                  urls: bool = False) -> None:
+                  urls: bool = False,
+                  store: Optional[DataStore] = None) -> None:
     """
-    Imports images into data store.
+    Imports images into data store. Images already in the store, compared by
+    content, are not imported again.
     :param images: The list of image path/URLs to import.
     :param labels: The image classes of the images.
     :param urls: Whether or not the images are URLs (otherwise paths).
+    :param store: The data store, or the default store.
     :return: None.
     """
+    store = get_store(store)
+    init_data_store(store)
     labels = labels if labels else [DEFAULT_CLASS for _ in images]
-    filenames = process_map(download_to_store if urls else copy_to_store,
-                            images)
-    df_old = pd.read_csv("data/log.csv", index_col="Index")
-    data = [[f, l, *[False for _ in CONVERSIONS.keys()]] for
-            f, l in zip(filenames, labels) if f is not None]
-    index_start = max(df_old.index, default=-1) + 1
-    index = list(range(index_start, index_start + len(data)))
-    df_new = pd.DataFrame(data, columns=df_old.columns, index=index)
-    df = df_old.append(df_new)
-    df.to_csv("data/log.csv", index_label="Index")
+    if urls:
+        filenames = bulk_download_to_store(images, store=store)
+    else:
+        filenames = process_map(copy_to_store, [(f, store) for f in images],
+                                packed=True, io_bound=True)
+    new = [(f, l, content_hash_of(f)) for f, l in zip(filenames, labels)
+           if f is not None]
+    insert_images(new, store)
+
+    # Remove files of duplicate images which were not recorded
+    recorded = set(select_images([f for f, _, _ in new], store=store)["File"])
+    for f, _, _ in new:
+        if f not in recorded:
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
 
 
 def _convert_image(image: str, conversions: List[str]) -> str:
@@ -95,26 +214,37 @@ def _convert_image(image: str, conversions: List[str]) -> str:
     :param conversions: The list of conversions to apply.
     :return: The converted image.
     """
-    for c in conversions:
-        image = CONVERSIONS[c](image)
-    return image
+    return convert_chain(image, conversions)
 
 
-def convert_images(images: List[str], conversions: List[str]) -> None:
+@traced("convert_images")
+def convert_images(images: List[str], conversions: List[str],
+                   store: Optional[DataStore] = None) -> None:
     """
     Destructively apply a set of conversions to a set of images in the main
-    store.
+    store. Images being converted by another job at the same time are
+    skipped.
     :param images: The list of images to work with.
     :param conversions: The list of conversions to apply.
+    :param store: The data store, or the default store.
     :return: None.
     """
-    df = pd.read_csv("data/log.csv", index_col="Index")
+    token = uuid.uuid4().hex
+    conversions_left = claim_conversions(images, conversions, token, store)
+    try:
+        new_files = process_map(_convert_image, conversions_left, packed=True)
+    except BaseException:
+        release_claims([f for f, _ in conversions_left], token, store)
+        raise
+    update_conversions([(old, new, c) for new, (old, c)
+                        in zip(new_files, conversions_left)], store)
 
-    conversions_left = [
-        (r["File"], [c for c in conversions if not r[c]])
-        for _, r in df.iterrows() if r["File"] in images
-    ]
-    new_files = process_map(_convert_image, conversions_left, packed=True)
-    for new, (old, c) in zip(new_files, conversions_left):
-        df.loc[df["File"] == old, ["File", *c]] = [new, *[True] * len(c)]
-    df.to_csv("data/log.csv", index_label="Index")
+
+def read_store(store: Optional[DataStore] = None) -> "pd.DataFrame":
+    """
+    Reads the metadata of every image in the data store.
+    :param store: The data store, or the default store.
+    :return: A data frame with the columns of the original metadata CSV:
+    File, Class and a flag per conversion, indexed by Index.
+    """
+    return select_images(store=store)
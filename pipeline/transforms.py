@@ -4,12 +4,38 @@ A set of tools to process image arrays. All transforms have the type
 
 To add a transform, add a function and then add a flag name to the TRANSFORMS
 global dictionary.
+
+Transforms can also be applied to a batch of images stacked into a single
+`(N, H, W[, C])` array with `apply_batch_transforms`. A vectorised batch
+version of a transform, of type
+`(block: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray`, can be
+added to the BATCH_TRANSFORMS global dictionary under the same flag name.
+Transforms without a batch version are applied image by image.
 """
 
-from typing import Callable, Dict
+import functools
+from typing import Callable, Dict, List, Optional
 
 import numpy as np
 
+from .profiling import span
+
+# Side length in pixels of the blocks averaged by "Downsample"
+BLOCK_SIZE = 8
+
+# Number of orientation bins per cell of "Gradient Histogram", over [0, pi)
+ORIENTATION_BINS = 9
+
+# Number of cells per side of the grid "Gradient Histogram" divides images into
+GRADIENT_CELLS = 4
+
+# Number of bins of "Intensity Histogram"
+INTENSITY_BINS = 32
+
+# Output dimension and random seed of "Random Projection"
+PROJECTION_DIM = 256
+PROJECTION_SEED = 0
+
 
 def scale_pixels(arr: np.ndarray) -> np.ndarray:
     """
@@ -34,8 +60,258 @@ def flatten(arr: np.ndarray) -> np.ndarray:
     return arr.flatten()
 
 
+def downsample(arr: np.ndarray) -> np.ndarray:
+    """
+    Downsamples an image by averaging blocks of BLOCK_SIZE x BLOCK_SIZE
+    pixels, dropping any partial blocks at the edges.
+    :param arr: An array representing an image.
+    :return: The downsampled float32 image, with the same number of channels.
+    """
+    return downsample_batch(arr[np.newaxis])[0]
+
+
+def gradient_histogram(arr: np.ndarray) -> np.ndarray:
+    """
+    Describes the edges of an image with histograms of gradient orientations,
+    weighted by gradient magnitude, over a GRADIENT_CELLS x GRADIENT_CELLS grid
+    of cells. Colour images are averaged to grayscale first.
+    :param arr: An array representing an image.
+    :return: The L2-normalised histograms of the cells, concatenated into a
+    float32 vector of length GRADIENT_CELLS ** 2 * ORIENTATION_BINS.
+    """
+    return gradient_histogram_batch(arr[np.newaxis])[0]
+
+
+def intensity_histogram(arr: np.ndarray) -> np.ndarray:
+    """
+    Describes an image by the distribution of its pixel values, over
+    INTENSITY_BINS bins covering [0, 255], or [0, 1] for scaled pixels.
+    :param arr: An array representing an image.
+    :return: The float32 histogram, normalised to sum to 1.
+    """
+    return intensity_histogram_batch(arr[np.newaxis])[0]
+
+
+def random_projection(arr: np.ndarray) -> np.ndarray:
+    """
+    Projects a flattened image onto PROJECTION_DIM random Gaussian directions,
+    approximately preserving distances between images. The projection is
+    fixed by PROJECTION_SEED and the size of the image.
+    :param arr: An array representing an image.
+    :return: The float32 projection.
+    """
+    return random_projection_batch(arr[np.newaxis])[0]
+
+
 # List of available transforms
 TRANSFORMS: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
     "Scale Pixels": scale_pixels,
-    "Flatten": flatten
+    "Flatten": flatten,
+    "Downsample": downsample,
+    "Gradient Histogram": gradient_histogram,
+    "Intensity Histogram": intensity_histogram,
+    "Random Projection": random_projection
 }
+
+
+def scale_pixels_batch(block: np.ndarray,
+                       out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Batch version of `scale_pixels`, scaling each image of a block separately.
+    :param block: A stacked array of images.
+    :param out: A float32 array of the same shape to write the result to.
+    :return: The scaled images.
+    """
+    n = len(block)
+    if out is None:
+        out = np.empty(block.shape, dtype="float32")
+    if n == 0:
+        return out
+    maxes = block.reshape(n, -1).max(axis=1, initial=0)
+    divisors = np.where(maxes > 1.0, 255.0, 1.0).astype("float32")
+    np.divide(block, divisors.reshape((n,) + (1,) * (block.ndim - 1)),
+              out=out, casting="unsafe")
+    return out
+
+
+def flatten_batch(block: np.ndarray,
+                  out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Batch version of `flatten`, flattening each image of a block. Returns a
+    view of the block where possible.
+    :param block: A stacked array of images.
+    :param out: An array of shape (N, H * W[ * C]) to write the result to.
+    :return: The flattened images.
+    """
+    flat = block.reshape(len(block), -1)
+    if out is None:
+        return flat
+    out[...] = flat
+    return out
+
+
+def downsample_batch(block: np.ndarray,
+                     out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Batch version of `downsample`.
+    :param block: A stacked array of images.
+    :param out: A float32 array of shape (N, H // BLOCK_SIZE,
+    W // BLOCK_SIZE[, C]) to write the result to.
+    :return: The downsampled images.
+    """
+    n, h, w = block.shape[:3]
+    h, w = h // BLOCK_SIZE, w // BLOCK_SIZE
+    blocks = block[:, :h * BLOCK_SIZE, :w * BLOCK_SIZE].reshape(
+        n, h, BLOCK_SIZE, w, BLOCK_SIZE, *block.shape[3:])
+    return np.mean(blocks, axis=(2, 4), dtype="float32", out=out)
+
+
+def _grayscale_batch(block: np.ndarray) -> np.ndarray:
+    """
+    Converts a block of images to float32 grayscale by averaging channels.
+    :param block: A stacked array of images.
+    :return: The (N, H, W) grayscale images.
+    """
+    if block.ndim == 4:
+        return block.mean(axis=3, dtype="float32")
+    return block.astype("float32", copy=False)
+
+
+def gradient_histogram_batch(block: np.ndarray,
+                             out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Batch version of `gradient_histogram`.
+    :param block: A stacked array of images.
+    :param out: A float32 array of shape
+    (N, GRADIENT_CELLS ** 2 * ORIENTATION_BINS) to write the result to.
+    :return: The histograms of each image.
+    """
+    n, h, w = block.shape[:3]
+    length = GRADIENT_CELLS ** 2 * ORIENTATION_BINS
+    if out is None:
+        out = np.empty((n, length), dtype="float32")
+    if n == 0:
+        return out
+    gy, gx = np.gradient(_grayscale_batch(block), axis=(1, 2))
+    magnitude = np.hypot(gx, gy)
+    orientation = np.arctan2(gy, gx) % np.pi
+    bins = np.minimum((orientation * (ORIENTATION_BINS / np.pi))
+                      .astype("int32"), ORIENTATION_BINS - 1)
+    # Index of the cell of each pixel, combined with its orientation bin
+    cells = ((np.arange(h) * GRADIENT_CELLS // h)[:, np.newaxis]
+             * GRADIENT_CELLS + np.arange(w) * GRADIENT_CELLS // w)
+    bins += (cells * ORIENTATION_BINS).astype("int32")
+    for i in range(n):
+        out[i] = np.bincount(bins[i].ravel(), magnitude[i].ravel(), length)
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    np.divide(out, norms, out=out, where=norms > 0)
+    return out
+
+
+def intensity_histogram_batch(block: np.ndarray,
+                              out: Optional[np.ndarray] = None) \
+        -> np.ndarray:
+    """
+    Batch version of `intensity_histogram`.
+    :param block: A stacked array of images.
+    :param out: A float32 array of shape (N, INTENSITY_BINS) to write the
+    result to.
+    :return: The histograms of each image.
+    """
+    n = len(block)
+    if out is None:
+        out = np.empty((n, INTENSITY_BINS), dtype="float32")
+    if n == 0:
+        return out
+    flat = block.reshape(n, -1)
+    maxes = flat.max(axis=1, initial=0)
+    scales = np.where(maxes > 1.0, INTENSITY_BINS / 256.0,
+                      INTENSITY_BINS / (1.0 + 1e-6)).astype("float32")
+    bins = np.clip((flat * scales[:, np.newaxis]).astype("int32"), 0,
+                   INTENSITY_BINS - 1)
+    for i in range(n):
+        out[i] = np.bincount(bins[i], minlength=INTENSITY_BINS)
+    out /= flat.shape[1]
+    return out
+
+
+@functools.lru_cache(maxsize=2)
+def _projection_matrix(dim: int) -> np.ndarray:
+    """
+    Generates the random projection matrix for inputs of a given size.
+    :param dim: The size of the flattened inputs.
+    :return: A float32 matrix of shape (dim, PROJECTION_DIM).
+    """
+    rng = np.random.default_rng(PROJECTION_SEED)
+    matrix = rng.standard_normal((dim, PROJECTION_DIM), dtype="float32")
+    matrix /= np.sqrt(PROJECTION_DIM)
+    return matrix
+
+
+def random_projection_batch(block: np.ndarray,
+                            out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Batch version of `random_projection`, projecting a block with a single
+    matrix product.
+    :param block: A stacked array of images.
+    :param out: A float32 array of shape (N, PROJECTION_DIM) to write the
+    result to.
+    :return: The projections of each image.
+    """
+    flat = block.reshape(len(block), int(np.prod(block.shape[1:]))) \
+        .astype("float32", copy=False)
+    return np.matmul(flat, _projection_matrix(flat.shape[1]), out=out)
+
+
+def batch_adapter(f: Callable[[np.ndarray], np.ndarray]) \
+        -> Callable[..., np.ndarray]:
+    """
+    Adapts a per-image transform to a batch transform.
+    :param f: A transform from TRANSFORMS.
+    :return: A batch transform applying `f` to each image of the block.
+    """
+    def _batch(block: np.ndarray,
+               out: Optional[np.ndarray] = None) -> np.ndarray:
+        results = [f(arr) for arr in block]
+        if out is None:
+            return np.array(results)
+        for i, arr in enumerate(results):
+            out[i] = arr
+        return out
+
+    return _batch
+
+
+# Vectorised batch versions of transforms
+BATCH_TRANSFORMS: Dict[str, Callable[..., np.ndarray]] = {
+    "Scale Pixels": scale_pixels_batch,
+    "Flatten": flatten_batch,
+    "Downsample": downsample_batch,
+    "Gradient Histogram": gradient_histogram_batch,
+    "Intensity Histogram": intensity_histogram_batch,
+    "Random Projection": random_projection_batch
+}
+
+
+def apply_batch_transforms(block: np.ndarray, transforms: List[str],
+                           out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Applies a series of transforms to a stacked block of images, using the
+    batch versions of transforms where available.
+    :param block: A stacked array of images.
+    :param transforms: The list of transforms to apply.
+    :param out: An array to write the result of the last transform to, which
+    must match its shape and type.
+    :return: The transformed images, with the same results as applying the
+    transforms to each image separately.
+    """
+    if not transforms:
+        if out is None:
+            return block
+        out[...] = block
+        return out
+    for i, t in enumerate(transforms):
+        f = BATCH_TRANSFORMS.get(t) or batch_adapter(TRANSFORMS[t])
+        with span(f"transform:{t}"):
+            block = f(block, out if i == len(transforms) - 1 else None)
+    return block
@@ -0,0 +1,313 @@
+"""
+A long-lived prediction service for models exported with `export_model`.
+
+The exported model is loaded once at startup. Requests are decoded and
+transformed in the handling thread, then coalesced into micro-batches so that
+concurrent requests share a single call to `classifier.predict`.
+
+Usage:
+    python server.py path/to/export/export.json --port 8000
+    python server.py path/to/export/export.json --socket /tmp/predict.sock
+
+Endpoints:
+    POST /predict   A JSON body `{"paths": [...]}` of image paths, or a raw
+                    image upload (any non-JSON content type).
+    GET  /stats     Latency percentiles and throughput counters.
+"""
+import argparse
+import io
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from modelling import decode_predictions, load_exported_model
+from pipeline.conversions import get_format
+from pipeline.dataset import image_to_data
+
+# Default micro-batching parameters
+MAX_BATCH_SIZE = 32
+MAX_WAIT = 0.005
+
+# Number of recent request latencies kept for percentile reporting
+LATENCY_WINDOW = 10000
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrently submitted images into batches for one classifier.
+    A batch is predicted once it reaches `max_batch_size` images or once its
+    first image has waited `max_wait` seconds.
+    """
+
+    def __init__(self, process: Dict[str, Any], classifier: Any,
+                 max_batch_size: int = MAX_BATCH_SIZE,
+                 max_wait: float = MAX_WAIT):
+        self.process = process
+        self.classifier = classifier
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[Tuple[np.ndarray, Future]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._started = time.perf_counter()
+        self._requests = 0
+        self._images = 0
+        self._batches = 0
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, arr: np.ndarray) -> Future:
+        """
+        Queues a transformed image for prediction.
+        :param arr: The transformed image data.
+        :return: A future resolving to the predicted class name.
+        """
+        future = Future()
+        self._queue.put((arr, future))
+        return future
+
+    def predict(self, arrs: List[np.ndarray]) -> List[str]:
+        """
+        Predicts a list of transformed images, blocking until all are done.
+        :param arrs: The transformed image data.
+        :return: The predicted class names.
+        """
+        start = time.perf_counter()
+        futures = [self.submit(a) for a in arrs]
+        result = [f.result() for f in futures]
+        with self._lock:
+            self._latencies.append(time.perf_counter() - start)
+            self._requests += 1
+        return result
+
+    def _next_batch(self) -> List[Tuple[np.ndarray, Future]]:
+        """
+        Blocks until at least one image is queued, then collects images until
+        the batch is full or the wait time of the first image has elapsed.
+        :return: The batch of queued images and their futures.
+        """
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        """
+        Worker loop predicting queued batches.
+        :return: None.
+        """
+        while True:
+            batch = self._next_batch()
+            try:
+                pred = self.classifier.predict(np.stack([a for a, _ in batch]))
+                labels = decode_predictions(self.process, pred)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), label in zip(batch, labels):
+                future.set_result(label)
+            with self._lock:
+                self._images += len(batch)
+                self._batches += 1
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns latency and throughput counters.
+        :return: An object of counters. Latencies are in milliseconds and
+        cover the most recent LATENCY_WINDOW requests.
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            uptime = time.perf_counter() - self._started
+            return {
+                "requests": self._requests,
+                "images": self._images,
+                "batches": self._batches,
+                "mean_batch_size": self._images / max(self._batches, 1),
+                "p50_ms": float(np.percentile(latencies, 50))
+                if len(latencies) else 0.0,
+                "p99_ms": float(np.percentile(latencies, 99))
+                if len(latencies) else 0.0,
+                "images_per_second": self._images / uptime,
+                "uptime_s": uptime
+            }
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """
+    Request handler for the prediction service. The micro-batcher is attached
+    to the server as `server.batcher`.
+    """
+
+    def _send_json(self, status: int, body: Any) -> None:
+        """
+        Sends a JSON response.
+        :param status: The HTTP status code.
+        :param body: The object to serialize.
+        :return: None.
+        """
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_images(self, body: bytes) -> List[np.ndarray]:
+        """
+        Decodes and transforms the images of a request.
+        :param body: The request body.
+        :return: The transformed image data.
+        """
+        process = self.server.batcher.process
+        conversions, transforms = process["Conversions"], process["Transforms"]
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            request = json.loads(body)
+            paths = request.get("paths") if isinstance(request, dict) \
+                else None
+            if not isinstance(paths, list) \
+                    or not all(isinstance(p, str) for p in paths):
+                raise ValueError('Expected a body of {"paths": [...]} with '
+                                 'a list of image paths')
+            arrs = []
+            for p in paths:
+                with Image.open(p) as img:
+                    arrs.append(image_to_data(img, conversions, transforms,
+                                              get_format(p)))
+            return arrs
+        else:
+            img = Image.open(io.BytesIO(body))
+            return [image_to_data(img, conversions, transforms)]
+
+    def do_GET(self) -> None:
+        """
+        Serves the stats endpoint.
+        :return: None.
+        """
+        if self.path == "/stats":
+            self._send_json(200, self.server.batcher.stats())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        """
+        Serves the predict endpoint.
+        :return: None.
+        """
+        if self.path != "/predict":
+            self._send_json(404, {"error": "not found"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            arrs = self._read_images(body)
+        except (OSError, ValueError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            predictions = self.server.batcher.predict(arrs)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, {"predictions": predictions})
+
+    def address_string(self) -> str:
+        """
+        Returns the client address for logging. Unix socket clients have none.
+        :return: The client address.
+        """
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    """
+    A threading HTTP server listening on a Unix socket.
+    """
+    daemon_threads = True
+
+    def get_request(self):
+        """
+        Accepts a request, substituting a placeholder client address.
+        :return: The request socket and client address.
+        """
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def make_server(exported_model: str, host: str = "127.0.0.1",
+                port: int = 8000, socket_path: Optional[str] = None,
+                max_batch_size: int = MAX_BATCH_SIZE,
+                max_wait: float = MAX_WAIT,
+                verify: bool = False) -> socketserver.BaseServer:
+    """
+    Loads an exported model and creates a prediction server for it.
+    :param exported_model: A model exported with `export_model`, as accepted
+    by `load_exported_model`.
+    :param host: The host to listen on, if serving over TCP.
+    :param port: The port to listen on, if serving over TCP.
+    :param socket_path: A Unix socket path to listen on instead of TCP.
+    :param max_batch_size: The maximum number of images per predict call.
+    :param max_wait: The maximum time in seconds an image waits for a batch.
+    :param verify: Whether to check the model against its checksum.
+    :return: The server, ready for `serve_forever`.
+    """
+    process, classifier = load_exported_model(exported_model, verify=verify)
+    if socket_path:
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+        server = UnixHTTPServer(socket_path, PredictionHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.batcher = MicroBatcher(process, classifier, max_batch_size,
+                                  max_wait)
+    return server
+
+
+def main() -> None:
+    """
+    Runs the prediction server from the command line.
+    :return: None.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("model", help="A model exported with export_model.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--socket", help="Serve on a Unix socket instead.")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT * 1000)
+    parser.add_argument("--verify", action="store_true",
+                        help="Check the model against its checksum.")
+    args = parser.parse_args()
+    server = make_server(args.model, args.host, args.port, args.socket,
+                         args.max_batch_size, args.max_wait_ms / 1000,
+                         args.verify)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
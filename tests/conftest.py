@@ -0,0 +1,46 @@
+"""
+Shared fixtures. The repository root and `benchmarks` are put on the path so
+that tests import the pipeline and the synthetic image generator as scripts
+in the repository do.
+"""
+import os
+import sys
+from typing import List, Tuple
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+
+from pipeline.context import DataStore  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path) -> DataStore:
+    """
+    :return: An empty data store in a temporary directory.
+    """
+    return DataStore(str(tmp_path / "data"))
+
+
+@pytest.fixture
+def exported_model(tmp_path, store) -> Tuple[str, List[str]]:
+    """
+    :return: A model exported after training on synthetic images, and the
+    paths of the images it was trained on.
+    """
+    pytest.importorskip("sklearn")
+    from sklearn.linear_model import SGDClassifier
+    from modelling import export_model, train_and_save
+    from pipeline.dataset import new_dataset
+    from pipeline.store import import_images, read_store
+    from synthetic import make_images
+
+    paths, labels = make_images(str(tmp_path / "inputs"), 12)
+    import_images(paths, labels, store=store)
+    dataset = new_dataset(list(read_store(store)["File"]),
+                          ["Grayscale", "Size Scaled"], store=store)
+    train_and_save(SGDClassifier(random_state=0), dataset,
+                   ["Downsample", "Scale Pixels", "Flatten"], False,
+                   store=store)
+    return export_model(dataset, str(tmp_path / "export")), paths
@@ -0,0 +1,61 @@
+"""
+Tests offline batch prediction: unusable images are recorded as errors, and
+an interrupted run resumed from its checkpoint writes the same output as an
+uninterrupted one.
+"""
+import pytest
+from PIL import Image
+
+from batch_predict import ResultWriter, _prepare, batch_predict
+
+# Number of images per chunk, small enough for several chunks per run
+CHUNK_SIZE = 4
+
+
+def test_prepare_records_mismatched_shapes(tmp_path):
+    fps = []
+    for name, size in [("a", (8, 8)), ("b", (8, 8)), ("c", (6, 8))]:
+        fps.append(str(tmp_path / f"{name}.png"))
+        Image.new("RGB", size).save(fps[-1])
+    fps.append(str(tmp_path / "missing.png"))
+    data, errors = _prepare(fps, {"Conversions": [], "Transforms": []})
+    assert data.shape[0] == 2
+    assert errors[:2] == [None, None]
+    assert "does not match" in errors[2]
+    assert errors[3] is not None
+
+
+@pytest.mark.parametrize("extension", ["csv", "jsonl"])
+def test_resume_after_interrupt(exported_model, tmp_path, monkeypatch,
+                                extension):
+    exported, paths = exported_model
+    inputs = str(tmp_path / "inputs")
+    with open(f"{inputs}/broken.png", "wb") as f:
+        f.write(b"not an image")
+    full, part = (str(tmp_path / f"{n}.{extension}") for n in ("full", "part"))
+    n = batch_predict(exported, [inputs], full, CHUNK_SIZE, verbose=False)
+    assert n == len(paths) + 1
+
+    # Fail partway through writing the third chunk, leaving a partial row
+    write = ResultWriter.write
+    calls = []
+
+    def interrupted(self, *args):
+        calls.append(args)
+        if len(calls) == 3:
+            self._file.write(b"partial")
+            raise KeyboardInterrupt
+        write(self, *args)
+
+    monkeypatch.setattr(ResultWriter, "write", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        batch_predict(exported, [inputs], part, CHUNK_SIZE, verbose=False)
+    monkeypatch.setattr(ResultWriter, "write", write)
+    n = batch_predict(exported, [inputs], part, CHUNK_SIZE, resume=True,
+                      verbose=False)
+    assert n == len(paths) + 1
+    with open(full) as f, open(part) as g:
+        output = f.readlines()
+        assert output == g.readlines()
+    broken = [line for line in output if "cannot identify" in line]
+    assert len(broken) == 1
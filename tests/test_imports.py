@@ -0,0 +1,12 @@
+"""
+Runs the cold import checks of `benchmarks/imports.py`, so that a heavy
+dependency imported at module level or a slow import fails the tests.
+"""
+import pytest
+
+from imports import BUDGET, CHECKS, check
+
+
+@pytest.mark.parametrize("module", list(CHECKS))
+def test_cold_import(module):
+    assert check(module, CHECKS[module], BUDGET, repeat=1) == []
@@ -0,0 +1,76 @@
+"""
+Checks that the in-memory prediction path produces the same model input as
+the on-disk dataset path, for each image format, colour mode and set of
+conversions.
+"""
+import itertools
+from typing import List
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from pipeline.conversions import CONVERSIONS
+from pipeline.dataset import load_images, make_data, new_dataset
+from pipeline.store import import_images, read_store
+
+from synthetic import make_images
+
+# Every subset of the conversions, in the order they are defined
+CONVERSION_SETS = [list(c) for n in range(len(CONVERSIONS) + 1)
+                   for c in itertools.combinations(CONVERSIONS, n)]
+
+# Image formats and the colour modes they are saved in
+IMAGES = [("png", "RGB"), ("png", "RGBA"), ("png", "L"), ("png", "P"),
+          ("jpg", "RGB"), ("jpg", "L"), ("bmp", "RGB"), ("gif", "P"),
+          ("tiff", "RGB"), ("tiff", "RGBA")]
+
+
+def _make_inputs(directory: str, extension: str, mode: str) -> List[str]:
+    """
+    Writes synthetic images in a format and colour mode.
+    :param directory: The directory to write the images to.
+    :param extension: The image format.
+    :param mode: The PIL colour mode.
+    :return: The paths to the images.
+    """
+    paths, _ = make_images(directory, 2)
+    converted = []
+    for fp in paths:
+        dest = f"{fp[:-4]}.{mode}.{extension}"
+        with Image.open(fp) as img:
+            img.convert(mode).save(dest)
+        converted.append(dest)
+    return converted
+
+
+@pytest.mark.parametrize("extension,mode", IMAGES)
+@pytest.mark.parametrize("conversions", CONVERSION_SETS, ids=str)
+def test_load_images_matches_make_data(tmp_path, store, extension, mode,
+                                       conversions):
+    paths = _make_inputs(str(tmp_path / "inputs"), extension, mode)
+    dataset = new_dataset(paths, conversions, from_store=False, store=store)
+    assert make_data(dataset, ["Scale Pixels"], False, cache=False,
+                     store=store)
+    expected = np.load(f"{dataset}/X.npy")
+    actual = load_images(paths, conversions, ["Scale Pixels"])
+    assert actual.dtype == expected.dtype
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_end_to_end_prediction_in_memory(tmp_path, store):
+    pytest.importorskip("sklearn")
+    from sklearn.linear_model import SGDClassifier
+    from modelling import end_to_end_prediction, export_model, train_and_save
+
+    paths, labels = make_images(str(tmp_path / "inputs"), 12)
+    import_images(paths, labels, store=store)
+    dataset = new_dataset(list(read_store(store)["File"]),
+                          ["Grayscale", "Size Scaled"], store=store)
+    train_and_save(SGDClassifier(random_state=0), dataset,
+                   ["Downsample", "Scale Pixels", "Flatten"], False,
+                   store=store)
+    exported = export_model(dataset, str(tmp_path / "export"))
+    on_disk = end_to_end_prediction(exported, paths, store=store)
+    in_memory = end_to_end_prediction(exported, paths, in_memory=True)
+    assert in_memory == on_disk
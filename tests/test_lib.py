@@ -0,0 +1,66 @@
+"""
+Checks of the shared worker pools of `process_map`, and of profiling maps
+run on them.
+"""
+import pytest
+
+from pipeline import lib, profiling
+
+# Worker count of the process pool under test, which must not be 1 so that
+# maps are not run serially
+POOL_SIZE = 2
+
+
+def _read(fp: str) -> str:
+    """
+    :param fp: A file, possibly relative to the working directory.
+    :return: The contents of the file.
+    """
+    with open(fp) as f:
+        return f.read()
+
+
+@pytest.fixture
+def process_pool(monkeypatch):
+    """
+    Maps with the process backend on a pool of POOL_SIZE workers, closing the
+    pool afterwards.
+    """
+    lib.shutdown()
+    monkeypatch.setattr(lib, "POOL_SIZE", POOL_SIZE)
+    yield
+    lib.shutdown()
+
+
+def test_process_map_follows_working_directory(process_pool, tmp_path,
+                                               monkeypatch):
+    n = POOL_SIZE * lib.MIN_TASKS_PER_WORKER
+    for name in ("first", "second"):
+        directory = tmp_path / name
+        directory.mkdir()
+        (directory / "input.txt").write_text(name)
+        monkeypatch.chdir(directory)
+        assert lib.process_map(_read, ["input.txt"] * n,
+                               backend="process") == [name] * n
+
+
+def _profiling_enabled(_) -> bool:
+    """
+    :return: Whether profiling is enabled in the calling process.
+    """
+    return profiling.is_enabled()
+
+
+def test_traced_map_leaves_workers_untraced(process_pool):
+    # Start the workers untraced, as they inherit the parent's state
+    n = POOL_SIZE * lib.MIN_TASKS_PER_WORKER
+    assert not any(lib.process_map(_profiling_enabled, range(n),
+                                   backend="process"))
+    profiling.enable()
+    try:
+        assert lib.process_map(_read, [__file__] * n, backend="process")
+    finally:
+        profiling.disable()
+        profiling.reset()
+    assert not any(lib.process_map(_profiling_enabled, range(n),
+                                   backend="process"))
@@ -0,0 +1,140 @@
+"""
+Tests bulk URL ingestion against a local stand-in HTTP server.
+"""
+import io
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator
+
+import pytest
+from PIL import Image
+
+from pipeline.retrieval import bulk_download_to_store, download_stats
+
+requests = pytest.importorskip("requests")
+
+
+def _png(color: str) -> bytes:
+    """
+    Encodes a small PNG.
+    :param color: The fill colour.
+    :return: The PNG file content.
+    """
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Serves `/ok/<colour>.png` images, `/flaky.png` failing with 503 until its
+    third request, `/html.png` with a non-image body, `/slow/<n>.png` after a
+    delay, and 404 for anything else.
+    """
+
+    def do_GET(self) -> None:
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.requests[self.path] = server.requests.get(self.path, 0) + 1
+            n = server.requests[self.path]
+        try:
+            if self.path.startswith("/ok/"):
+                self._send(200, _png(self.path[4:-4]))
+            elif self.path.startswith("/slow/"):
+                time.sleep(0.05)
+                self._send(200, _png(f"#{int(self.path[6:-4]):06x}"))
+            elif self.path == "/flaky.png":
+                self._send(503 if n < 3 else 200, _png("red"))
+            elif self.path == "/html.png":
+                self._send(200, b"<html><body>not an image</body></html>")
+            else:
+                self._send(404, b"")
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _send(self, status: int, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def server() -> Iterator[ThreadingHTTPServer]:
+    """
+    :return: A running stand-in image server on a free local port.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.lock = threading.Lock()
+    server.active = server.max_active = 0
+    server.requests: Dict[str, int] = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _url(server: ThreadingHTTPServer, path: str) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_bulk_download(server, store):
+    os.makedirs(store.images)
+    urls = [_url(server, p) for p in
+            ["/ok/blue.png", "/ok/green.png", "/flaky.png", "/html.png",
+             "/missing.png"]]
+    stats: Dict[str, float] = {}
+    paths = bulk_download_to_store(urls, backoff=0.01, store=store,
+                                   stats=stats)
+
+    assert [p is not None for p in paths] == [True, True, True, False, False]
+    for p in paths[:3]:
+        with Image.open(p) as img:
+            assert img.size == (8, 8)
+    assert server.requests["/flaky.png"] == 3
+    assert server.requests["/missing.png"] == 1
+    assert stats["downloaded"] == 3
+    assert stats["rejected"] == 1
+    assert stats["failed"] == 1
+    assert stats["retries"] == 2
+    assert stats["images_per_second"] > 0
+    assert download_stats() == stats
+    assert sorted(os.listdir(store.images)) == \
+        sorted(os.path.basename(p) for p in paths[:3])
+
+
+def test_per_host_limit(server, store):
+    os.makedirs(store.images)
+    urls = [_url(server, f"/slow/{i}.png") for i in range(12)]
+    paths = bulk_download_to_store(urls, workers=8, per_host=2, store=store)
+    assert all(paths)
+    assert server.max_active <= 2
+
+
+def test_concurrent_calls_keep_separate_limits_and_stats(server, store):
+    os.makedirs(store.images)
+    results: Dict[int, Dict[str, float]] = {1: {}, 4: {}}
+
+    def run(per_host: int, n: int) -> None:
+        urls = [_url(server, f"/slow/{per_host * 100 + i}.png")
+                for i in range(n)]
+        bulk_download_to_store(urls, workers=8, per_host=per_host,
+                               store=store, stats=results[per_host])
+
+    first = threading.Thread(target=run, args=(1, 4))
+    first.start()
+    run(4, 8)
+    first.join()
+    assert results[1]["downloaded"] == 4
+    assert results[4]["downloaded"] == 8
+    # Up to one download of the first call and four of the second at once
+    assert 2 < server.max_active <= 5
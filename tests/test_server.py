@@ -0,0 +1,74 @@
+"""
+Tests the prediction server over HTTP, with concurrent requests coalesced
+into micro-batches.
+"""
+import json
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator, Tuple
+
+import pytest
+
+# Number of concurrent single-image requests
+REQUESTS = 12
+
+
+@pytest.fixture
+def server(exported_model) -> Iterator[Tuple[Any, str]]:
+    """
+    :return: A running prediction server on a free local port, and its URL.
+    """
+    from server import make_server
+
+    # A long wait so that the concurrent requests share batches
+    server = make_server(exported_model[0], port=0, max_wait=0.2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def _post(url: str, body: Any) -> Tuple[int, Any]:
+    """
+    Posts a JSON body to the predict endpoint.
+    :param url: The server URL.
+    :param body: The object to send.
+    :return: The status code and the decoded response.
+    """
+    request = urllib.request.Request(
+        f"{url}/predict", json.dumps(body).encode(),
+        {"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_concurrent_predictions(server, exported_model):
+    from modelling import end_to_end_prediction
+
+    server, url = server
+    exported, paths = exported_model
+    paths = (paths * REQUESTS)[:REQUESTS]
+    expected = end_to_end_prediction(exported, paths, in_memory=True)
+    with ThreadPoolExecutor(REQUESTS) as executor:
+        responses = list(executor.map(lambda p: _post(url, {"paths": [p]}),
+                                      paths))
+    assert [status for status, _ in responses] == [200] * REQUESTS
+    assert [body["predictions"][0] for _, body in responses] == expected
+    stats = server.batcher.stats()
+    assert stats["requests"] == REQUESTS
+    assert stats["mean_batch_size"] > 1
+
+
+@pytest.mark.parametrize("body", [{"paths": 5}, {"paths": [5]}, [],
+                                  {"images": []}, "paths"])
+def test_malformed_request(server, body):
+    _, url = server
+    status, response = _post(url, body)
+    assert status == 400
+    assert "error" in response
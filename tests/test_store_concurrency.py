@@ -0,0 +1,63 @@
+"""
+Stress test of concurrent use of a data store: several processes import and
+convert images at the same time, and no metadata row or file may be lost,
+duplicated or orphaned.
+"""
+import multiprocessing as mp
+import os
+
+from pipeline.context import DataStore
+from pipeline.store import convert_images, import_images, read_store
+
+from synthetic import make_images
+
+# Number of producer processes and images each imports
+PROCESSES = 6
+IMAGES = 20
+
+# Images of the shared seed are imported by every process
+SHARED_SEED = 1000
+
+CONVERSIONS = ["Grayscale", "Size Scaled"]
+
+
+def _produce(root: str, inputs: str, seed: int) -> None:
+    """
+    Imports a set of images of its own and a set shared with every other
+    process, then converts everything in the store.
+    :param root: The root of the data store.
+    :param inputs: The directory to generate images in.
+    :param seed: The seed of the images of this process.
+    :return: None.
+    """
+    from pipeline import lib
+    lib.configure(cpu_backend="serial")
+    store = DataStore(root)
+    for s in (seed, SHARED_SEED):
+        paths, labels = make_images(f"{inputs}/{seed}", IMAGES, s)
+        import_images(paths, labels, store=store)
+        convert_images(list(read_store(store)["File"]), CONVERSIONS, store)
+
+
+def test_concurrent_import_and_convert(tmp_path):
+    root = str(tmp_path / "data")
+    context = mp.get_context("spawn")
+    processes = [context.Process(target=_produce,
+                                 args=(root, str(tmp_path / "inputs"), seed))
+                 for seed in range(PROCESSES)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    assert all(p.exitcode == 0 for p in processes)
+
+    # Every process converts the whole store after each of its imports, so
+    # every image is converted by the process which imported it or by the
+    # process holding its claim
+    store = DataStore(root)
+    df = read_store(store)
+    assert len(df) == (PROCESSES + 1) * IMAGES
+    assert df["File"].is_unique
+    assert df[CONVERSIONS].all().all()
+    files = {f"{store.images}/{f}" for f in os.listdir(store.images)}
+    assert files == set(df["File"])